@@ -4,9 +4,11 @@
 # wl-07-10-2024, Mon: commence
 
 from lamp import __version__
+import os
 import argparse
 import sys
 import sqlite3
+import pandas as pd
 from PySide6.QtWidgets import QApplication
 from lamp import gui
 from lamp import anno
@@ -28,6 +30,35 @@ def main():
                                       help='Annotate metabolites in CLI.')
     parser_gui = subparsers.add_parser('gui',
                                        help='Annotate metabolites in GUI.')
+    parser_bi = subparsers.add_parser('build-index',
+                                      help='Build reference index file.')
+
+    # ---------------------------------------------------------------------
+    # reference index with reference and adduct files
+    parser_bi.add_argument('--ref-path', type=str, default=None,
+                           required=False, nargs="+",
+                           help="Reference files for compound matching."
+                                " Several files are merged into one index"
+                                " and tagged with column 'library'.")
+    parser_bi.add_argument('--ref-sep', default="tab", type=str,
+                           choices=["tab", "comma"],
+                           help="Values in input or output file are "
+                                "separated by this character.")
+    parser_bi.add_argument('--ion-mode', default='pos', type=str,
+                           choices=["pos", "neg"],
+                           help="Ion mode of data set.")
+    parser_bi.add_argument('--cal-mass', action="store_true",
+                           help="Calculate mass based on NIST database.")
+    parser_bi.add_argument('--add-path', type=str, default=None,
+                           required=False,
+                           help="Adducts library for compound match mass"
+                                " adjustment.")
+    parser_bi.add_argument('--add-sep', default="tab", type=str,
+                           choices=["tab", "comma"],
+                           help="Values in input or output file are "
+                                "separated by this character.")
+    parser_bi.add_argument('--index-out', type=str, required=True,
+                           help="Directory of reference index.")
 
     # ---------------------------------------------------------------------
     # data loading
@@ -54,17 +85,57 @@ def main():
                            help="Correlation method.")
     parser_am.add_argument('--positive', action='store_true',
                            help="Positive corelation coefficients or not.")
+    parser_am.add_argument('--corr-engine', default='tile', type=str,
+                           choices=["tile", "dense", "sparse"],
+                           help="Engine for correlation analysis. 'tile'"
+                                " filters pairs tile by tile, 'dense' uses"
+                                " full matrices and 'sparse' only"
+                                " correlates pairs inside the retention time"
+                                " window.")
+    parser_am.add_argument('--grouping', default='neighbors', type=str,
+                           choices=["neighbors", "components", "cliques"],
+                           help="Grouping of correlated features. 'neighbors'"
+                                " groups each feature with its correlated"
+                                " features, 'components' and 'cliques'"
+                                " assign each feature to one group of"
+                                " connected or all mutually correlated"
+                                " features. 'cliques' is a greedy"
+                                " partition, so its groups are not always"
+                                " maximal cliques.")
+    parser_am.add_argument('--max-memory', default=None, type=str,
+                           help="Memory budget of correlation analysis in"
+                                " bytes or with unit, e.g. '4G'. Default is"
+                                " unlimited.")
+    parser_am.add_argument('--float32', action='store_true',
+                           help="Calculate correlation in single"
+                                " precision.")
 
     # ---------------------------------------------------------------------
     # compounds annotation with reference and adduct files
-    parser_am.add_argument('--ppm', default=5.0, type=float,
-                           help="Mass tolerance in parts per million.")
+    parser_am.add_argument('--ppm', default="5.0", type=str,
+                           help="Mass tolerance in parts per million. Use"
+                                " comma separated values, e.g. '2,5,10',"
+                                " to match once for several tolerances.")
+    parser_am.add_argument('--engine', default='numpy', type=str,
+                           choices=["numpy", "sweep", "sqlite"],
+                           help="Engine for compound matching.")
+    parser_am.add_argument('--n-jobs', default=1, type=int,
+                           help="Number of processes for compound matching"
+                                " and threads for correlation analysis. -1"
+                                " means using all processors.")
+    parser_am.add_argument('--rt-tol', default=None, type=float,
+                           help="Tolerance of retention time for compound"
+                                " matching. Reference must have 'rt' or"
+                                " 'retention_time' column.")
     parser_am.add_argument('--ion-mode', default='pos', type=str,
                            choices=["pos", "neg"],
                            help="Ion mode of data set.")
     parser_am.add_argument('--ref-path', type=str, default=None,
-                           required=False,
-                           help="Reference file for compound matching.")
+                           required=False, nargs="+",
+                           help="Reference files or reference indexes for"
+                                " compound matching. Several libraries are"
+                                " matched in one pass and tagged with"
+                                " column 'library'.")
     parser_am.add_argument('--ref-sep', default="tab", type=str,
                            choices=["tab", "comma"],
                            help="Values in input or output file are "
@@ -79,6 +150,9 @@ def main():
                            choices=["tab", "comma"],
                            help="Values in input or output file are "
                                 "separated by this character.")
+    parser_am.add_argument('--no-cache', action="store_true",
+                           help="Do not use on-disk cache of prepared"
+                                " references.")
 
     # ---------------------------------------------------------------------
     # results outcome
@@ -117,21 +191,42 @@ def main():
 
         # -----------------------------------------------------------------
         # load adducts library for mass adjust if mass calculation is needed
-        lib_add = anno.read_lib(fn=args.add_path,
+        ref_path = args.ref_path or [""]
+        add_path = args.add_path
+        if not add_path:
+            add_path = next((x for x in ref_path if anno.is_index(x) and
+                             anno.read_index_meta(x)["adducts"]), None)
+        lib_add = anno.read_lib(fn=add_path,
                                 ion_mode=args.ion_mode,
                                 sep=separators[args.add_sep])
 
         # -----------------------------------------------------------------
-        # load reference library and calculate exact mass if needed.
-        ref = anno.read_ref(fn=args.ref_path,
-                            ion_mode=args.ion_mode,
-                            sep=separators[args.ref_sep],
-                            calc=args.cal_mass,
-                            lib_adducts=lib_add)
+        # load reference libraries and calculate exact mass if needed.
+        ref = read_ref(ref_path, ion_mode=args.ion_mode,
+                       sep=separators[args.ref_sep], calc=args.cal_mass,
+                       lib_adducts=lib_add, cache=not args.no_cache)
+        print_mass_cache()
 
         # -----------------------------------------------------------------
         # match compound based on exact mass
-        match = anno.comp_match_mass(df, args.ppm, ref)
+        ppm_list = [float(item.strip()) for item in args.ppm.split(',')]
+        multi = len(ppm_list) > 1
+        if multi:
+            # match once with the widest tolerance and split by tolerance
+            match_all = anno.comp_match_mass_ppm(df, ppm_list, ref,
+                                                 engine=args.engine,
+                                                 n_jobs=args.n_jobs,
+                                                 rt_tol=args.rt_tol)
+            matches = [
+                match_all[match_all.ppm == x]
+                .drop("ppm", axis=1).reset_index(drop=True)
+                for x in ppm_list
+            ]
+        else:
+            matches = [anno.comp_match_mass(df, ppm_list[0], ref,
+                                            engine=args.engine,
+                                            n_jobs=args.n_jobs,
+                                            rt_tol=args.rt_tol)]
 
         # -----------------------------------------------------------------
         # correlation analysis with corr, pval and rt_diff
@@ -140,20 +235,37 @@ def main():
                                   thres_corr=args.thres_corr,
                                   thres_pval=args.thres_pval,
                                   method=args.method,
-                                  positive=args.positive)
+                                  positive=args.positive,
+                                  engine=args.corr_engine,
+                                  max_memory=args.max_memory,
+                                  n_jobs=args.n_jobs,
+                                  dtype="float32" if args.float32 else None)
 
         # get correlation group and size
-        corr_df = stats.corr_grp_size(corr)
+        corr_df = stats.corr_grp_size(corr, grouping=args.grouping)
 
         # -----------------------------------------------------------------
-        # get summary of metabolite annotation
-        sr, mr = anno.comp_summ(df, match)
-        # merge summery table with correlation analysis
-        res = anno.comp_summ_corr(sr, corr_df)
+        # get summary of metabolite annotation for each tolerance
+        summ = []
+        for ppm, match in zip(ppm_list, matches):
+            sr, mr = anno.comp_summ(df, match)
+            # merge summery table with correlation analysis
+            res = anno.comp_summ_corr(sr, corr_df)
+            summ.append((ppm, match, mr, res))
 
         # -----------------------------------------------------------------
         # save all results to a sqlite database or not
         if args.save_db:
+            if multi:
+                # tag tables with tolerance
+                match, mr, res = [
+                    pd.concat([x[i].assign(ppm=x[0]) for x in summ],
+                              ignore_index=True)
+                    for i in (1, 2, 3)
+                ]
+            else:
+                _, match, mr, res = summ[0]
+
             conn = sqlite3.connect(args.db_out)
             df[["name", "mz", "rt"]].to_sql("peaklist", conn,
                                             if_exists="replace", index=False)
@@ -166,12 +278,34 @@ def main():
             conn.commit()
             conn.close()
 
-        # save multiple row results or not
-        if args.save_mr:
-            mr.to_csv(args.mr_out, sep=separators[args.mr_sep], index=False)
+        # one file per tolerance if several tolerances
+        for ppm, match, mr, res in summ:
+            mr_out, sr_out = args.mr_out, args.sr_out
+            if multi:
+                root, ext = os.path.splitext(args.mr_out)
+                mr_out = "{}_ppm{:g}{}".format(root, ppm, ext)
+                root, ext = os.path.splitext(args.sr_out)
+                sr_out = "{}_ppm{:g}{}".format(root, ppm, ext)
+
+            # save multiple row results or not
+            if args.save_mr:
+                mr.to_csv(mr_out, sep=separators[args.mr_sep], index=False)
 
-        # save results
-        res.to_csv(args.sr_out, sep=separators[args.sr_sep], index=False)
+            # save results
+            res.to_csv(sr_out, sep=separators[args.sr_sep], index=False)
+
+    if args.step == "build-index":
+        lib_add = anno.read_lib(fn=args.add_path,
+                                ion_mode=args.ion_mode,
+                                sep=separators[args.add_sep])
+        ref_path = args.ref_path or [""]
+        ref = read_ref(ref_path, ion_mode=args.ion_mode,
+                       sep=separators[args.ref_sep], calc=args.cal_mass,
+                       lib_adducts=lib_add, cache=False)
+        print_mass_cache()
+        anno.write_index(args.index_out, ref, lib_adducts=lib_add,
+                         ion_mode=args.ion_mode, calc=args.cal_mass,
+                         source=",".join(ref_path))
 
     if args.step == "gui":
         # Exception Handling
@@ -188,6 +322,24 @@ def main():
             print(sys.exc_info()[1])
 
 
+# -------------------------------------------------------------------------
+# Load one reference library, or several libraries tagged by library
+def read_ref(ref_path, **kwargs):
+    if len(ref_path) == 1:
+        return anno.read_ref(fn=ref_path[0], **kwargs)
+    return anno.read_refs(ref_path, **kwargs)
+
+
+# -------------------------------------------------------------------------
+# Report formula mass cache if exact mass was calculated
+def print_mass_cache():
+    info = anno.mass_cache_info()
+    if info["rows"]:
+        print("Exact mass: {} formulas, {} unique, {} cache hits, {} "
+              "calculated.".format(info["rows"], info["unique"],
+                                   info["hits"], info["misses"]))
+
+
 # -------------------------------------------------------------------------
 if __name__ == '__main__':
     main()
@@ -1,13 +1,27 @@
 import os
 import re
+import json
+import shutil
 import sqlite3
+import hashlib
+import tempfile
+import functools
+import itertools
 import pandas as pd
 import numpy as np
 import janitor
-from pyteomics import mass
+from scipy.sparse import coo_matrix
+from scipy.spatial import cKDTree
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import lamp
-from lamp.utils import (df2dict, flatten_cols, flatten_list)
+from lamp.utils import (df2dict, flatten_cols, get_n_jobs, get_cache_dir,
+                        get_cache_size, file_hash)
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 # ------------------------------------------------------------------------
@@ -243,7 +257,7 @@ def _comp_summ_1(pk, comp):
 # -------------------------------------------------------------------------
 # wl-29-04-2024, Mon: Compound match without adducts library
 # wl-06-08-2024, Tue: The only requirement from 'ref' is 'exact_mass'
-def comp_match_mass(peak, ppm, ref):
+def comp_match_mass(peak, ppm, ref, engine="numpy", n_jobs=1, rt_tol=None):
     """
     Compound match.
 
@@ -259,6 +273,24 @@ def comp_match_mass(peak, ppm, ref):
         A value for ppm.
     ref : DataFrame
         A pandas data frame of a library which must have `exact_mass` column.
+    engine : {'numpy', 'sweep', 'sqlite'}
+        Matching engine:
+        * numpy : sort exact mass once and search all peaks' ppm windows
+          in a single vectorised call
+        * sweep : merge sorted peak windows and sorted exact mass in one
+          linear sweep. It is compiled with `numba` if installed.
+        * sqlite : query an in-memory sqlite table peak by peak
+    n_jobs : int
+        Number of processes for matching. Peaks are partitioned by m/z
+        range and each process searches the overlapping slice of sorted
+        exact mass. -1 means using all processors. Only for 'numpy' and
+        'sweep' engines.
+    rt_tol : float
+        Tolerance of retention time. If given, reference must have `rt` or
+        `retention_time` column in the same unit as peak table, and both
+        mass and retention time are searched in a 2-D index. Reference
+        records or peaks with missing retention time are matched on mass
+        only.
 
     Returns
     -------
@@ -271,516 +303,1579 @@ def comp_match_mass(peak, ppm, ref):
         adducts library to adjust compound match.
     """
 
-    # ---------------------------------------------------------------------
-    # wl-29-04-2024, Mon: select compounds based on exact mass
-    def comp_sel_mass(tab_name, col_names, cur, peak_id, mz, ppm):
-        min, max = _cal_mass_tol(mz, ppm)
-        rec = []
-        cur.execute(
-            """
-            SELECT * from {} where exact_mass >= {} and exact_mass <= {}
-            """.format(tab_name, min, max)
-        )
-        rec = [OrderedDict(zip(col_names, list(record)))
-               for record in cur.fetchall()]
-        for record in rec:
-            record["id"] = peak_id
-            record["mz"] = mz
-            record["ppm_error"] = (mz - record["exact_mass"]) / (
-                record["exact_mass"] * 0.000001
-            )
-        return rec
+    if engine in ("numpy", "sweep"):
+        return _comp_match_np(peak, ppm, ref, engine=engine, n_jobs=n_jobs,
+                              rt_tol=rt_tol)
+    elif engine == "sqlite":
+        return _comp_match_mass_sql(peak, ppm, ref, rt_tol=rt_tol)
+    else:
+        raise ValueError("Engine must be 'numpy', 'sweep' or 'sqlite'.")
 
-    # ---------------------------------------------------------------------
-    # convert df to sql for speedy match
-    con = sqlite3.connect(":memory:")
+
+# -------------------------------------------------------------------------
+# wl-29-04-2024, Mon: Compound match without adducts library
+def _comp_match_mass_sql(peak, ppm, ref, rt_tol=None):
+    """Internal function for `comp_match_mass` with sqlite engine."""
+
+    name, mz = _peak_arr(peak)
+    ref = ref[~_ref_dup(ref)].reset_index(drop=True)
+    rt = _rt_arr(peak, ref, np.arange(len(ref)), rt_tol)
+    con = _ref_sql(ref, rt=rt is not None)
     cur = con.cursor()
-    ref.to_sql(name='ref', con=con, if_exists="replace", index=False)
-    con.commit()
+    query, rt_tol = _ref_sql_query(rt)
+
+    # annotation/match compounds. Only row positions are fetched.
+    pk_idx, pos = [], []
+    for i, x in enumerate(mz):
+        min, max = _cal_mass_tol(x, ppm)
+        pk_rt = None if rt is None else _sql_val(rt[0][i])
+        cur.execute(query, (min, max) + ((pk_rt, pk_rt, rt_tol) if rt else ()))
+        rec = [x[0] for x in cur.fetchall()]
+        pos.extend(rec)
+        pk_idx.extend([i] * len(rec))
+
+    con.close()
+
+    return _match_res(ref, np.arange(len(ref)),
+                      ref["exact_mass"].to_numpy(dtype=float), name, mz,
+                      np.array(pk_idx, dtype=np.int64),
+                      np.array(pos, dtype=np.int64))
+
+
+# -------------------------------------------------------------------------
+# Copy exact mass of reference into sqlite for speedy query
+def _ref_sql(ref, rt=False):
+    """
+    Copy exact mass of reference into an in-memory sqlite table.
+
+    Parameters
+    ----------
+    ref : DataFrame
+        A pandas data frame of reference library which must have
+        `exact_mass` column.
+    rt : bool
+        Copy retention time as column `rt` or not.
+
+    Returns
+    -------
+    Connection
+        A sqlite connection with table `ref` indexed by `exact_mass`. Row
+        id minus one is the row position of `ref`.
+    """
 
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tab_name = list(cur.fetchall())[0][0]
+    con = sqlite3.connect(":memory:")
+    tab = ref[["exact_mass"]]
+    if rt:
+        tab = tab.assign(rt=ref[_ref_rt(ref)].astype(float))
+    tab.to_sql(name='ref', con=con, if_exists="replace", index=False)
     # set index for fast query
-    cur.execute(
-        "CREATE INDEX idx_exact_mass ON {} (exact_mass)".format(tab_name))
+    con.execute("CREATE INDEX idx_exact_mass ON ref (exact_mass)")
+    con.commit()
 
-    # get table column names
-    if True:
-        col_names = ref.columns.to_list()
-    else:
-        cur.execute("SELECT * FROM {}".format(tab_name))
-        col_names = list(map(lambda x: x[0], cur.description))
+    return con
 
-    # convert peak list to dictionary for query
-    pk = df2dict(peak[["name", "mz"]])
 
-    # annotation/match compounds
-    res = [comp_sel_mass(tab_name, col_names, cur, x, pk[x], ppm)
-           for x in pk]
-    res = flatten_list(res)
-    res = pd.DataFrame(res)
+# -------------------------------------------------------------------------
+# Get sqlite query of compound match
+def _ref_sql_query(rt=None):
+    """Internal function to get sqlite query and retention time tolerance."""
+
+    query = "SELECT rowid - 1 from ref where exact_mass >= ? and " \
+            "exact_mass <= ?"
+    if rt is None:
+        return query, None
 
-    res = (
-        res
-        .round({"ppm_error": 2, "exact_mass": 2})
-        # .sort_values(["id", "compound_id"], ignore_index=True)
-        .drop_duplicates(ignore_index=True)
-    )
+    query += " and (? is null or rt is null or abs(rt - ?) <= ?)"
 
-    # move id and mz at the front
-    cols_to_move = ['id', 'mz']
-    res = res[cols_to_move +
-              [x for x in res.columns if x not in cols_to_move]]
+    return query, rt[2]
 
-    con.close()
 
-    return res
+# -------------------------------------------------------------------------
+# Convert missing value for sqlite
+def _sql_val(x):
+    """Internal function to convert NaN as None for sqlite."""
+
+    return None if np.isnan(x) else float(x)
 
 
 # -------------------------------------------------------------------------
-# wl-24-04-2024, Wed: compound match
-# Convert data frame 'ref' to sqlite for speedy query
-# wl-06-08-2024, Tue: The only requirement from 'ref' is 'exact_mass'
-# wl-07-08-2024, Wed: 'adduct' in peak has nothing to do with lib_adducts.
-def comp_match_mass_add(peak, ppm, ref, lib_adducts):
+# Compound match with several mass tolerances in one pass
+def comp_match_mass_ppm(peak, ppm, ref, lib_adducts=None, engine="numpy",
+                        n_jobs=1, rt_tol=None):
     """
-    Compound match.
+    Compound match with several mass tolerances.
 
-    This function performs compound match against exact mass in reference
-    library and adducts library.
+    Compounds are matched once with the widest tolerance and the match of
+    each tolerance is derived from it, so a tolerance sweep costs about the
+    same as a single match.
 
     Parameters
     ----------
     peak : DataFrame
         A pandas data frame of peak table. It must have "name", "mz" and
         "rt" columns.
-    ppm : float
-        A value for ppm.
+    ppm : list
+        A list of ppm values.
     ref : DataFrame
         A pandas data frame of reference library which must have
         `exact_mass` column.
     lib_adducts : DataFrame
         A pandas data frame of adducts library which must have `exact_mass`
-        column.
+        column. If None, adducts library is not used.
+    engine : {'numpy', 'sweep', 'sqlite'}
+        Matching engine. See `comp_match_mass`. The 'sqlite' engine matches
+        each tolerance separately.
+    n_jobs : int
+        Number of processes for matching. See `comp_match_mass`.
+    rt_tol : float
+        Tolerance of retention time. See `comp_match_mass`.
 
     Returns
     -------
     DataFrame
-        A pandas dataframe of compound match table.
+        A pandas dataframe of compound match table with `ppm` column of
+        tolerance at the front. Rows of each tolerance are the same as
+        `comp_match_mass` or `comp_match_mass_add` with that tolerance.
+    """
 
-    See Also
+    ppm = [float(x) for x in ppm]
+
+    if engine == "sqlite":
+        if lib_adducts is None:
+            res = [comp_match_mass(peak, x, ref, engine=engine,
+                                   rt_tol=rt_tol) for x in ppm]
+        else:
+            res = [comp_match_mass_add(peak, x, ref, lib_adducts,
+                                       engine=engine, rt_tol=rt_tol)
+                   for x in ppm]
+    elif engine in ("numpy", "sweep"):
+        name, mz = _peak_arr(peak)
+        lib = None if lib_adducts is None else _lib_arr(lib_adducts)
+        order, mass = _sort_mass(ref, adduct=lib is not None)
+        rt = _rt_arr(peak, ref, order, rt_tol)
+
+        # match once with the widest tolerance
+        pk_idx, pos, add_idx = _match_hits(mz, max(ppm), mass, lib,
+                                           engine=engine, skip=False,
+                                           n_jobs=n_jobs, rt=rt)
+
+        # filter on the same windows as a single match
+        res = []
+        for x in ppm:
+            idx = _in_window(mz[pk_idx], mass[pos], x, lib, add_idx)
+            res.append(_match_res(ref, order, mass, name, mz, pk_idx[idx],
+                                  pos[idx], lib,
+                                  None if lib is None else add_idx[idx]))
+    else:
+        raise ValueError("Engine must be 'numpy', 'sweep' or 'sqlite'.")
+
+    res = [tab.assign(ppm=x) for tab, x in zip(res, ppm)]
+    res = pd.concat(res, ignore_index=True)
+    res = res[["ppm"] + [x for x in res.columns if x != "ppm"]]
+
+    return res
+
+
+# -------------------------------------------------------------------------
+# Compound match of peak table chunk by chunk
+def iter_match_mass(peak, ppm, ref, lib_adducts=None, chunk_size=10000,
+                    engine="numpy", rt_tol=None):
+    """
+    Compound match of peak table chunk by chunk.
+
+    This function is a generator version of `comp_match_mass` and
+    `comp_match_mass_add`. Reference is sorted once and peaks are matched in
+    chunks, so memory is bounded by the hits of a chunk rather than all
+    hits.
+
+    Parameters
+    ----------
+    peak : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    ppm : float
+        A value for ppm.
+    ref : DataFrame
+        A pandas data frame of reference library which must have
+        `exact_mass` column.
+    lib_adducts : DataFrame
+        A pandas data frame of adducts library which must have `exact_mass`
+        column. If None, adducts library is not used.
+    chunk_size : int
+        Number of peaks in each chunk.
+    engine : {'numpy', 'sweep'}
+        Matching engine. See `comp_match_mass`.
+    rt_tol : float
+        Tolerance of retention time. See `comp_match_mass`.
+
+    Yields
+    ------
+    DataFrame
+        Compound match table of a chunk of peaks. Concatenation of all
+        chunks is the same as `comp_match_mass` or `comp_match_mass_add`.
+
+    Examples
     --------
-    com_match_mass : Return compound match table. This function does not use
-        adducts library to adjust compound match.
+    >>> res = iter_match_mass(peak, 5.0, ref, chunk_size=5000)
+    >>> write_match(res, "match.tsv")
     """
 
-    # --------------------------
-    # convert df to sql for speedy match
-    con = sqlite3.connect(":memory:")
-    cur = con.cursor()
-    ref.to_sql(name='ref', con=con, if_exists="replace", index=False)
-    con.commit()
+    if engine not in ("numpy", "sweep"):
+        raise ValueError("Engine must be either 'numpy' or 'sweep'.")
+    if chunk_size < 1:
+        raise ValueError("Chunk size must be a positive integer.")
 
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tab_name = list(cur.fetchall())[0][0]
-    # set index for fast query
-    cur.execute(
-        "CREATE INDEX idx_exact_mass ON {} (exact_mass)".format(tab_name))
+    name, mz = _peak_arr(peak)
+    lib = None if lib_adducts is None else _lib_arr(lib_adducts)
+    order, mass = _sort_mass(ref, adduct=lib is not None)
+    rt = _rt_arr(peak, ref, order, rt_tol)
 
-    # get table column names
-    if True:
-        col_names = ref.columns.to_list()
-    else:
-        cur.execute("SELECT * FROM {}".format(tab_name))
-        col_names = list(map(lambda x: x[0], cur.description))
+    for i in range(0, max(len(mz), 1), chunk_size):
+        sub = slice(i, i + chunk_size)
+        rt_sub = None if rt is None else (rt[0][sub],) + rt[1:]
+        pk_idx, pos, add_idx = _match_hits(mz[sub], ppm, mass, lib,
+                                           engine=engine, rt=rt_sub)
+        yield _match_res(ref, order, mass, name[sub], mz[sub], pk_idx, pos,
+                         lib, add_idx)
 
-    # --------------------------
-    # convert peak list to dictionary for query
-    pk = df2dict(peak[["name", "mz"]])
-    # pk = peak.set_index('name').T.to_dict('records')[0]
 
-    # convert lib_adducts to dictionary for query
-    lib = (
-        lib_adducts
-        .rename(columns={"exact_mass": "mass"})
-        # .set_index('label').T.to_dict('list')
-        .set_index('label').T.to_dict('dict')
-    )
+# -------------------------------------------------------------------------
+# Write chunks of compound match table to a file
+def write_match(res, fn, sep="\t", table="match"):
+    """
+    Write chunks of compound match table to a file.
 
-    # annotation/match compounds
-    res = [_comp_sel(lib, tab_name, col_names, cur, x, pk[x], ppm)
-           for x in pk]
-    res = flatten_list(res)
-    res = pd.DataFrame(res)
+    Each chunk is appended to the file once it is available, so the whole
+    match table is never held in memory.
 
-    # clean up
-    res = (
-        res
-        .round({"ppm_error": 2, "exact_mass": 2})
-        # .sort_values(["id", "compound_id"], ignore_index=True)
-        # .drop_duplicates(['id', 'compound_id'], ignore_index=True)
-        .drop_duplicates(ignore_index=True)
-    )
+    Parameters
+    ----------
+    res : iterable
+        Chunks of compound match table, e.g. from `iter_match_mass`.
+    fn : str
+        Output file. Extensions of db, sqlite and sqlite3 are written into
+        a sqlite database. Others are written as delimited text.
+    sep : str
+        Delimiter for text file.
+    table : str
+        Table name for sqlite database. It will be replaced if it exists.
 
-    # move id and mz at the front
-    cols_to_move = ['id', 'mz']
-    res = res[cols_to_move +
-              [x for x in res.columns if x not in cols_to_move]]
+    Returns
+    -------
+    int
+        Number of rows written.
+    """
 
-    con.close()
+    ext = os.path.splitext(fn)[1][1:]
+    n = 0
+    if ext in ['db', 'sqlite', 'sqlite3']:
+        con = sqlite3.connect(fn)
+        for i, chunk in enumerate(res):
+            chunk.to_sql(table, con, index=False,
+                         if_exists="replace" if i == 0 else "append")
+            con.commit()
+            n += len(chunk)
+        con.close()
+    else:
+        for i, chunk in enumerate(res):
+            chunk.to_csv(fn, sep=sep, index=False, mode="w" if i == 0 else "a",
+                         header=(i == 0))
+            n += len(chunk)
 
-    return res
+    return n
 
 
 # -------------------------------------------------------------------------
-# wl-11-01-2024, Thu: select compounds based on exact mass
-# wl-24-04-2024, Wed: use all column names
-def _comp_sel(lib, tab_name, col_names, cur, peak_id, mz, ppm):
-    """Internal function for `comp_match_mass_add`."""
+# Compound match with sorted exact mass
+def _comp_match_np(peak, ppm, ref, lib_adducts=None, engine="numpy",
+                   n_jobs=1, rt_tol=None):
+    """Internal function for `comp_match_mass` and `comp_match_mass_add`."""
 
-    min_mz, max_mz = _cal_mass_tol(mz, ppm)
-    adducts = lib.keys()
+    name, mz = _peak_arr(peak)
+    lib = None if lib_adducts is None else _lib_arr(lib_adducts)
 
-    rec = []
-    for adduct in adducts:    # adduct = '[M+Mg]+'
-        if min_mz - lib[adduct]["mass"] < 0.5:
-            continue
+    # sort exact mass once. Missing mass never matches.
+    order, mass = _sort_mass(ref, adduct=lib is not None)
+    rt = _rt_arr(peak, ref, order, rt_tol)
 
-        min = (min_mz - lib[adduct]["mass"]) * lib[adduct]["charge"]
-        max = (max_mz - lib[adduct]["mass"]) * lib[adduct]["charge"]
+    pk_idx, pos, add_idx = _match_hits(mz, ppm, mass, lib, engine=engine,
+                                       n_jobs=n_jobs, rt=rt)
 
-        cur.execute(
-            """
-            SELECT * from {} where exact_mass >= {} and exact_mass <= {}
-            """.format(tab_name, min, max)
-        )
+    return _match_res(ref, order, mass, name, mz, pk_idx, pos, lib, add_idx)
 
-        sub = [OrderedDict(zip(col_names, list(record)))
-               for record in cur.fetchall()]
 
-        for record in sub:
-            record["exact_mass"] = (
-                record["exact_mass"] / lib[adduct]["charge"]
-                + lib[adduct]["mass"]
-            )
-            record["adduct"] = adduct
+# -------------------------------------------------------------------------
+# Get peak list as arrays
+def _peak_arr(peak):
+    """
+    Get peak names and m/z values as arrays.
 
-        rec.extend(sub)
+    Peaks go through a dictionary as the sqlite engine does, so duplicated
+    names keep the last m/z value.
 
-    for record in rec:
-        record["id"] = peak_id
-        record["mz"] = mz
-        record["ppm_error"] = (mz - record["exact_mass"]) / (
-            record["exact_mass"] * 0.000001
-        )
+    Parameters
+    ----------
+    peak : DataFrame
+        A pandas data frame of peak table with "name" and "mz" columns.
+
+    Returns
+    -------
+    name : ndarray
+        Peak names.
+    mz : ndarray
+        Peak m/z values.
+    """
 
-    return rec
+    pk = df2dict(peak[["name", "mz"]])
+    name = np.array(list(pk.keys()), dtype=object)
+    mz = np.array(list(pk.values()), dtype=float)
+
+    return name, mz
 
 
 # -------------------------------------------------------------------------
-# wl-22-04-2024, Mon: calculate mass tolerance/range based on ppm
-# wl-11-10-2024, Fri: Review
-def _cal_mass_tol(mass, ppm):
+# Get adducts library as arrays
+def _lib_arr(lib_adducts):
     """
-    Calculate m/z value tolerance/range.
+    Get adducts library as arrays.
 
     Parameters
     ----------
-    mass : float
-        A mass value.
-    ppm : float
-        ppm value.
+    lib_adducts : DataFrame
+        A pandas data frame of adducts library with "label", "exact_mass"
+        and "charge" columns.
 
     Returns
     -------
-    min_tol : float
-        Minimal tolerance.
-    max_tol : float
-        Maximal tolerance.
+    tuple
+        Arrays of adduct labels, masses and charges.
     """
 
-    delta = 0.000001
-    min_tol = (1 - delta * ppm) * mass
-    max_tol = (1 + delta * ppm) * mass
+    lib = (
+        lib_adducts
+        .rename(columns={"exact_mass": "mass"})
+        .set_index('label').T.to_dict('dict')
+    )
+    label = np.array(list(lib.keys()), dtype=object)
+    add_mass = np.array([lib[x]["mass"] for x in label], dtype=float)
+    charge = np.array([lib[x]["charge"] for x in label], dtype=float)
 
-    return min_tol, max_tol
+    return label, add_mass, charge
 
 
-# -----------------------------------------------------------------------
-# wl-22-04-2024, Mon: calculate molecular formula' exact mass
-# wl-23-04-2024, Tue: fix a bug. use argument names for 'calculate_mass'
-# wl-06-08-2024, Tue: exception handling. how to catch user-defined error:
-#  PyteomicsError?
-def _cal_mass(formula, mass_data):
+# -------------------------------------------------------------------------
+# Get retention time of peaks and sorted reference as arrays
+def _rt_arr(peak, ref, order, rt_tol=None):
     """
-    Calculate molecular formula's exact mass
+    Get retention time of peaks and sorted reference as arrays.
 
     Parameters
     ----------
-    formula : str
-        A string with a chemical formula.
-    mass_data : OrderedDict
-        A dict with the masses of the chemical elements.
+    peak : DataFrame
+        A pandas data frame of peak table with "name" and "rt" columns.
+    ref : DataFrame
+        A pandas data frame of reference library with `rt` or
+        `retention_time` column.
+    order : ndarray
+        Row positions of `ref` in ascending order of exact mass.
+    rt_tol : float
+        Tolerance of retention time.
 
     Returns
     -------
-    float
-        A mass value
+    tuple
+        Retention time of peaks in the same order as `_peak_arr`, retention
+        time of reference in the order of `order` and `rt_tol`. None if
+        `rt_tol` is None.
     """
 
-    formula = str(formula)
-    try:
-        res = mass.calculate_mass(formula=formula, mass_data=mass_data)
-        # res = round(res, 6)
-    # except (KeyError, PyteomicsError, NameError):
-    except Exception:
-        res = np.nan
+    if rt_tol is None:
+        return None
+    if not rt_tol > 0:
+        raise ValueError("Tolerance of retention time must be positive.")
 
-    return res
+    pk_rt = df2dict(peak[["name", "rt"]])
+    pk_rt = np.array(list(pk_rt.values()), dtype=float)
+    ref_rt = ref[_ref_rt(ref)].to_numpy(dtype=float)[order]
 
+    return pk_rt, ref_rt, float(rt_tol)
 
-# -----------------------------------------------------------------------
-# wl-08-08-2024, Thu: adjust molecular formula' exact mass
-# wl-06-11-2024, Wed: Re-write
-def _adj_mass(mass, adduct, add_dict):
+
+# -------------------------------------------------------------------------
+# Get retention time column of reference
+def _ref_rt(ref):
+    """Get retention time column name of reference."""
+
+    for col in ("rt", "retention_time"):
+        if col in ref.columns:
+            return col
+
+    raise ValueError("Reference must have 'rt' or 'retention_time' column"
+                     " for retention time match.")
+
+
+# -------------------------------------------------------------------------
+# Match mass windows of peaks against sorted exact mass
+def _match_hits(mz, ppm, mass, lib=None, engine="numpy", skip=True,
+                n_jobs=1, rt=None):
     """
-    Adjust mass based on adduct library
+    Match mass windows of peaks against sorted exact mass.
 
     Parameters
     ----------
-    mass : float
-        Mass value to be adjusted.
-    adduct : str
-        A string of adduct. It is used to match against 'add_dict'.
-    add_dict : dict
-        A dictionary of adducts library.
+    mz : ndarray
+        Peak m/z values.
+    ppm : float
+        A value for ppm.
+    mass : ndarray
+        Exact mass of reference in ascending order.
+    lib : tuple
+        Arrays of adduct labels, masses and charges. If None, peaks are
+        matched without adducts.
+    engine : {'numpy', 'sweep'}
+        Use `_search_mass` or `_sweep_join`.
+    skip : bool
+        Skip adducts heavier than peak or not.
+    n_jobs : int
+        Number of processes for searching. See `_search_par`.
+    rt : tuple
+        Retention time of peaks and sorted reference, and its tolerance
+        from `_rt_arr`. If None, retention time is not used.
 
     Returns
     -------
-    float
-        Adjusted mass
+    pk_idx : ndarray
+        Peak index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit.
+    add_idx : ndarray
+        Adduct index of each hit, or None without adducts library. Hits are
+        ordered by peak, adduct and mass.
     """
 
-    if adduct in add_dict:
-        adj = mass + add_dict[adduct]
+    min_mz, max_mz = _cal_mass_tol(mz, ppm)
+
+    if lib is None:
+        pk_idx, pos = _search_par(min_mz, max_mz, mass, engine, n_jobs, rt)
+        return pk_idx, pos, None
+
+    # neutral mass windows of peak x adduct
+    _, add_mass, charge = lib
+    lo = (min_mz[:, None] - add_mass) * charge
+    hi = (max_mz[:, None] - add_mass) * charge
+    if skip:
+        # skip adducts heavier than peak, as sqlite engine does
+        keep = ~(min_mz[:, None] - add_mass < 0.5)
     else:
-        adj = mass
+        keep = np.ones(lo.shape, dtype=bool)
+    pk_win, add_win = np.nonzero(keep)
+    if rt is not None:
+        rt = (rt[0][pk_win],) + rt[1:]
 
-    return adj
+    # search all windows in one go
+    win_idx, pos = _search_par(lo[keep], hi[keep], mass, engine, n_jobs, rt)
 
+    return pk_win[win_idx], pos, add_win[win_idx]
 
-# -----------------------------------------------------------------------
-# wl-22-04-2024, Mon: calculate exact mass for a reference data frame
-# wl-07-08-2024, Wed: problem if adduct does not match in adduct library
-# wl-08-08-2024, Thu: fix a bug in mass adjustment
-def cal_mass(df, lib_adducts=None):
+
+# -------------------------------------------------------------------------
+# Check hits are inside mass windows of a tolerance
+def _in_window(mz, mass, ppm, lib=None, add_idx=None):
     """
-    Calculate exact mass for an reference data frame.
+    Check hits are inside mass windows of a tolerance.
 
-    This function calculates exact mass using NIST database. If the
-    reference file has 'adduct' column and user provides a adducts library,
-    the exact mass will be adjust according to the adducts library.
+    The windows are computed in the same way as `_match_hits`.
 
     Parameters
     ----------
-    df : DataFrame
-        An reference data frame. It must have a column called
-        'molecular_formula'.
-    lib_adducts : DataFrame
-        Adducts library in data frame format for mass adjustment. Only for
-        'df' has 'ion_type' column.
+    mz : ndarray
+        Peak m/z value of each hit.
+    mass : ndarray
+        Reference exact mass of each hit.
+    ppm : float
+        A value for ppm.
+    lib : tuple
+        Arrays of adduct labels, masses and charges, or None.
+    add_idx : ndarray
+        Adduct index of each hit, or None.
 
     Returns
     -------
-    DataFrame
-        Reference dataframe with exact mass.
+    ndarray
+        A boolean array.
     """
 
-    # --------------------------------------------------------------------
-    def parse_nist_database(fn, skip_lines=10):
-        """
-        Parse NIST database.
-
-        This function is called by `nist_database_to_pyteomics`.
-
-        Parameters
-        ----------
-        fn : str
-            Text file (NISTs Linearized ASCII Output)
-        skip_lines : integer
-            The number of lines of the data file to skip before beginning to
-            read data.
-
-        Yields
-        ------
-        Ordered dictionary
-            Containing the parsed records
-
-        Notes
-        -----
-        This function is from python package `beamspy`.
-        """
-
-        with open(fn, "r") as inp:
-            for i in range(skip_lines):
-                inp.readline()
-            for e in inp.read().split("\n\n"):
-                record = OrderedDict()
-                for line in e.strip().split("\n"):
-                    kv = line.split(" =")
-                    if kv[0] == "Relative Atomic Mass":
-                        record[kv[0]] = re.findall(r'\d+(?:\.\d+)?', kv[1])
-                        record[kv[0]][0] = float(record[kv[0]][0])
-                        record[kv[0]][1] = int(record[kv[0]][1])
-
-                    elif kv[0] == "Isotopic Composition":
-                        matches = re.findall(r'\d+(?:\.\d+)?', kv[1])
-                        if len(matches) > 0:
-                            record[kv[0]] = matches
-                            if len(matches) > 1:
-                                record[kv[0]][0] = float(record[kv[0]][0])
-                                record[kv[0]][1] = int(record[kv[0]][1])
-                            else:
-                                record[kv[0]] = [float(record[kv[0]][0]), None]
-                        else:
-                            record[kv[0]] = [0.0, None]
-                    elif kv[0] == "Atomic Number" or kv[0] == "Mass Number":
-                        record[kv[0]] = int(kv[1])
-                    elif kv[0] == "Standard Atomic Weight":
-                        matches = re.findall(r'\d+(?:\.\d+)?', kv[1])
-                        record[kv[0]] = matches
-                    else:
-                        record[kv[0]] = kv[1].strip()
-                yield record
+    min_mz, max_mz = _cal_mass_tol(mz, ppm)
 
-    # --------------------------------------------------------------------
-    def nist_database_to_pyteomics(fn, skip_lines=10):
-        """
-        Convert NIST database to dict for calculation of mass
-
-        Parameters
-        ----------
-        fn : str
-            Text file (NISTs Linearized ASCII Output)
-        skip_lines : integer
-            The number of lines of the data file to skip before beginning to
-            read data.
-
-        Returns
-        -------
-        dict
-            Ordered dictionary containing NIST records compatible with
-            `Pyteomics`.
-
-        Notes
-        -----
-        This function is from python package `beamspy`.
-        """
-
-        def add_record(r, nm):
-            if r["Atomic Symbol"] not in nm:
-                # update after all records have been added
-                nm[r["Atomic Symbol"]] = OrderedDict([(0, (0.0, 0.0))])
-                nm[r["Atomic Symbol"]][r["Mass Number"]] = (
-                    r["Relative Atomic Mass"][0], r["Isotopic Composition"][0])
-            else:
-                nm[r["Atomic Symbol"]][r["Mass Number"]] = (
-                    r["Relative Atomic Mass"][0], r["Isotopic Composition"][0])
-            return nm
-
-        def order_composition_by_hill(composition):
-            symbols = set(composition)
-            if 'C' in symbols:
-                symbols.remove('C')
-                yield 'C'
-                if 'H' in symbols:
-                    symbols.remove('H')
-                    yield 'H'
-            for symbol in sorted(symbols):
-                yield symbol
-
-        lib = OrderedDict()
-        for record in parse_nist_database(fn, skip_lines=skip_lines):
-            if record["Atomic Symbol"] in ["D", "T"]:
-                lib = add_record(record, lib)
-                record["Atomic Symbol"] = "H"
-                lib = add_record(record, lib)
-            else:
-                lib = add_record(record, lib)
-
-        for element in list(lib.keys()):
-            lib_sorted = sorted(lib[element].items(),
-                                key=lambda e: e[1][1], reverse=True)
-            if lib_sorted[0][1][0] > 0.0:
-                lib[element][0] = (lib_sorted[0][1][0], 1.0)
-            elif len(lib_sorted) == 2:
-                lib[element][0] = (lib_sorted[1][1][0], 1.0)
-            else:
-                del lib[element]
-
-        es = list(order_composition_by_hill(lib.keys()))
-
-        return OrderedDict((k, lib[k]) for k in es)
+    if lib is None:
+        return (mass >= min_mz) & (mass <= max_mz)
 
-    # --------------------------------------------------------------------
-    nist_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                             'lib', 'nist_database.txt')
-    nist_mass = nist_database_to_pyteomics(nist_path)
+    _, add_mass, charge = lib
+    add_mass = add_mass[add_idx]
+    charge = charge[add_idx]
 
-    # get exact mass
-    df = (
-        df
-        # wl-08-08-2024, Thu: use Series's apply here for single columns
-        .assign(exact_mass=lambda x:
-                x.molecular_formula.apply(_cal_mass, mass_data=nist_mass))
+    return (
+        ~(min_mz - add_mass < 0.5)
+        & (mass >= (min_mz - add_mass) * charge)
+        & (mass <= (max_mz - add_mass) * charge)
     )
 
-    # adjust exact mass or not
-    if ("adduct" in df.columns) and (lib_adducts is not None):
-        # convert 2-column df into dictionary for speedy query
-        add = df2dict(lib_adducts.iloc[:, 0:2])
-        df = (
-            df
-            # wl-08-08-2024, Thu: use df's apply here with multiple columns
-            #  and cell-wise custom function.
-            .assign(exact_mass=lambda x: x.apply(
-                lambda x: _adj_mass(x.exact_mass, x.adduct, add), axis=1))
-        )
-
-    return df
-
 
-# ------------------------------------------------------------------------
-# wl-22-04-2024, Mon: load reference file for compound annotation
-# wl-08-08-2024, Thu: use 'cal_mass' function
-# wl-10-09-2024, Tue: remove empty rows and columns
-# wl-11-09-2024, Wed: rename 'name' as 'molecular_name' in case 'name'
-#   conflicts with data set's peak 'name'.
-# wl-09-10-2024, Wed: set 'filename' default value
-# wl-23-10-2024, Wed: support Excel
-# wl-30-10-2024, Wed: add ion_mode
-def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
-             lib_adducts=None):
+# -------------------------------------------------------------------------
+# Get compound match table from hits
+def _match_res(ref, order, mass, name, mz, pk_idx, pos, lib=None,
+               add_idx=None):
     """
-    Load reference for compound annotation
+    Get compound match table from hits.
 
     Parameters
     ----------
-    fn : str
-        Full path for an reference file. If empty, use default reference
-        file. This file must have `formula` or `molecular_formula` column.
-        The current supported file formats are text formats (csv, tsv, txt
-        and dat) and Excel formats (xls, xlsx).
-    ion_mode : str
-        A string for ion mode, "pos" or "neg".
-    sheet_name: str or int
-        This argument is used for Excel file format. Strings are used for
-        sheet names. Integers are used in zero-indexed sheet positions
-        (chart sheets do not count as a sheet position).
+    ref : DataFrame
+        Reference library.
+    order : ndarray
+        Row positions of `ref` in ascending order of exact mass.
+    mass : ndarray
+        Sorted exact mass.
+    name : ndarray
+        Peak names.
+    mz : ndarray
+        Peak m/z values.
+    pk_idx : ndarray
+        Peak index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit.
+    lib : tuple
+        Arrays of adduct labels, masses and charges, or None.
+    add_idx : ndarray
+        Adduct index of each hit, or None.
 
-        Available cases:
+    Returns
+    -------
+    DataFrame
+        A pandas dataframe of compound match table.
+    """
 
-        * Defaults to ``0``: 1st sheet as a `DataFrame`
+    # de-duplicate on peak, reference row and adduct
+    key = {"peak": pk_idx, "ref": pos}
+    if add_idx is not None:
+        key["adduct"] = add_idx
+    idx = ~pd.DataFrame(key).duplicated().to_numpy()
+    pk_idx, pos = pk_idx[idx], pos[idx]
+    if add_idx is not None:
+        add_idx = add_idx[idx]
+
+    exact_mass = mass[pos]
+    adduct = None
+    if lib is not None:
+        label, add_mass, charge = lib
+        # mass back-transform
+        exact_mass = exact_mass / charge[add_idx] + add_mass[add_idx]
+        adduct = label[add_idx]
+
+    res = _match_tab(ref, order[pos], name[pk_idx], mz[pk_idx], exact_mass,
+                     adduct=adduct)
+    res = res.round({"ppm_error": 2, "exact_mass": 2})
+
+    # move id and mz at the front
+    cols_to_move = ['id', 'mz']
+    res = res[cols_to_move +
+              [x for x in res.columns if x not in cols_to_move]]
+
+    return res
+
+
+# -------------------------------------------------------------------------
+# Sort reference by exact mass for binary search
+def _sort_mass(ref, adduct=False):
+    """
+    Sort exact mass of reference library.
+
+    Parameters
+    ----------
+    ref : DataFrame
+        A pandas data frame of reference library which must have
+        `exact_mass` column.
+    adduct : bool
+        Match with adducts library or not. See `_ref_dup`.
+
+    Returns
+    -------
+    order : ndarray
+        Row positions of `ref` in ascending order of exact mass. Rows with
+        missing exact mass and duplicated rows are excluded.
+    mass : ndarray
+        Sorted exact mass.
+    """
+
+    em = ref["exact_mass"].to_numpy(dtype=float)
+    order = np.flatnonzero(~np.isnan(em) & ~_ref_dup(ref, adduct))
+    # stable sort keeps row order for tied mass as sqlite index does
+    order = order[np.argsort(em[order], kind="stable")]
+
+    return order, em[order]
+
+
+# -------------------------------------------------------------------------
+# Get duplicated reference rows in compound match table
+def _ref_dup(ref, adduct=False):
+    """
+    Get duplicated reference rows in compound match table.
+
+    Columns `id`, `mz` and `ppm_error` (and `adduct` if matched with adducts
+    library) are replaced in compound match table, so reference rows only
+    differing in these columns give duplicated matches.
+
+    Parameters
+    ----------
+    ref : DataFrame
+        A pandas data frame of reference library.
+    adduct : bool
+        Match with adducts library or not.
+
+    Returns
+    -------
+    ndarray
+        A boolean array. True for duplicates except the first occurrence.
+    """
+
+    drop = ["id", "mz", "ppm_error"] + (["adduct"] if adduct else [])
+    cols = [x for x in ref.columns if x not in drop]
+
+    return ref.duplicated(subset=cols).to_numpy()
+
+
+# -------------------------------------------------------------------------
+# Search mass windows in parallel processes
+def _search_par(lo, hi, mass, engine="numpy", n_jobs=1, rt=None):
+    """
+    Search mass windows against sorted mass in parallel processes.
+
+    Windows are sorted and split into `n_jobs` contiguous mass ranges. Each
+    process only gets the slice of `mass` overlapping its range and results
+    are merged in window order, so the output is the same as the serial
+    search.
+
+    Parameters
+    ----------
+    lo : ndarray
+        Lower bounds of mass windows (inclusive).
+    hi : ndarray
+        Upper bounds of mass windows (inclusive).
+    mass : ndarray
+        Mass values in ascending order.
+    engine : {'numpy', 'sweep'}
+        Use `_search_mass` or `_sweep_join`.
+    n_jobs : int
+        Number of processes. -1 means using all processors.
+    rt : tuple
+        Retention time of windows and `mass`, and its tolerance. If given,
+        windows are searched with `_search_rt` whatever the engine.
+
+    Returns
+    -------
+    qry_idx : ndarray
+        Window index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit.
+    """
+
+    n_jobs = min(get_n_jobs(n_jobs), len(lo))
+    if n_jobs <= 1:
+        return _search_task(lo, hi, mass, engine, rt)
+
+    # partition windows by mass range. Missing windows never match.
+    win = np.flatnonzero(~(np.isnan(lo) | np.isnan(hi)))
+    win = win[np.argsort(lo[win], kind="stable")]
+    parts = [x for x in np.array_split(win, n_jobs) if len(x)]
+
+    # overlapping slice of mass for each partition
+    start = [np.searchsorted(mass, lo[x].min(), side="left") for x in parts]
+    stop = [max(np.searchsorted(mass, hi[x].max(), side="right"), a)
+            for x, a in zip(parts, start)]
+
+    if rt is None:
+        rt_parts = [None] * len(parts)
+    else:
+        rt_parts = [(rt[0][x], rt[1][a:z], rt[2])
+                    for x, a, z in zip(parts, start, stop)]
+
+    with ProcessPoolExecutor(max_workers=len(parts)) as ex:
+        res = list(ex.map(_search_task,
+                          [lo[x] for x in parts], [hi[x] for x in parts],
+                          [mass[a:z] for a, z in zip(start, stop)],
+                          [engine] * len(parts), rt_parts))
+
+    # merge in window order. Hits of a window are from the same partition.
+    qry_idx = np.concatenate([x[q] for x, (q, _) in zip(parts, res)])
+    pos = np.concatenate([p + a for (_, p), a in zip(res, start)])
+    idx = np.argsort(qry_idx, kind="stable")
+
+    return qry_idx[idx], pos[idx]
+
+
+# -------------------------------------------------------------------------
+# Search mass windows with an engine
+def _search_task(lo, hi, mass, engine="numpy", rt=None):
+    """Internal function for `_search_par`."""
+
+    if engine not in ("numpy", "sweep"):
+        raise ValueError("Engine must be either 'numpy' or 'sweep'.")
+
+    # retention time is searched in the 2-D index by every engine
+    if rt is not None:
+        return _search_rt(lo, hi, rt[0], mass, rt[1], rt[2])
+    elif engine == "sweep":
+        return _sweep_join(lo, hi, mass)
+    else:
+        return _search_mass(lo, hi, mass)
+
+
+# -------------------------------------------------------------------------
+# Search mass windows against sorted mass
+def _search_mass(lo, hi, mass):
+    """
+    Search mass windows against sorted mass.
+
+    Parameters
+    ----------
+    lo : ndarray
+        Lower bounds of mass windows (inclusive).
+    hi : ndarray
+        Upper bounds of mass windows (inclusive).
+    mass : ndarray
+        Mass values in ascending order.
+
+    Returns
+    -------
+    qry_idx : ndarray
+        Window index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit. Hits of a window are in ascending
+        order of mass.
+    """
+
+    start = np.searchsorted(mass, lo, side="left")
+    stop = np.searchsorted(mass, hi, side="right")
+    cnt = np.maximum(stop - start, 0)
+
+    qry_idx = np.repeat(np.arange(len(cnt)), cnt)
+    # offset of each hit inside its window
+    off = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+    pos = start[qry_idx] + off
+
+    return qry_idx, pos
+
+
+# -------------------------------------------------------------------------
+# Search mass and retention time windows in a 2-D index
+def _search_rt(lo, hi, qrt, mass, rrt, rt_tol):
+    """
+    Search mass and retention time windows in a 2-D index.
+
+    Reference records are indexed by a KD-tree of log mass and retention
+    time. A ppm window has a constant width in log mass, so both constraints
+    are applied in one box query of the tree and only hits on the window
+    boundary need an exact check.
+
+    Parameters
+    ----------
+    lo : ndarray
+        Lower bounds of mass windows (inclusive).
+    hi : ndarray
+        Upper bounds of mass windows (inclusive).
+    qrt : ndarray
+        Retention time of windows.
+    mass : ndarray
+        Mass values in ascending order.
+    rrt : ndarray
+        Retention time of `mass`.
+    rt_tol : float
+        Tolerance of retention time.
+
+    Returns
+    -------
+    qry_idx : ndarray
+        Window index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit. Hits of a window are in ascending
+        order of mass.
+    """
+
+    res = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))]
+    qry_has = ~np.isnan(qrt)
+    ref_has = ~np.isnan(rrt)
+
+    # windows without retention time are matched on mass only
+    idx = np.flatnonzero(~qry_has)
+    if len(idx):
+        qry_idx, pos = _search_mass(lo[idx], hi[idx], mass)
+        res.append((idx[qry_idx], pos))
+
+    # so are records without retention time
+    ref_idx = np.flatnonzero(~ref_has)
+    idx = np.flatnonzero(qry_has)
+    if len(ref_idx) and len(idx):
+        qry_idx, pos = _search_mass(lo[idx], hi[idx], mass[ref_idx])
+        res.append((idx[qry_idx], ref_idx[pos]))
+
+    # 2-D index of log mass and retention time
+    ref_idx = np.flatnonzero(ref_has & (mass > 0))
+    idx = np.flatnonzero(qry_has & (hi > 0) & ~np.isnan(lo))
+    if len(ref_idx) and len(idx):
+        l_lo = np.log(np.maximum(lo[idx], np.finfo(float).tiny))
+        l_hi = np.log(hi[idx])
+        cen = (l_lo + l_hi) / 2
+        wid = (l_hi - l_lo) / 2
+
+        # scale log mass by the typical window width, so a window is a box
+        # of radius one in both dimensions
+        scale = np.median(wid[wid > 0]) if (wid > 0).any() else 1.0
+        tree = cKDTree(np.column_stack([np.log(mass[ref_idx]) / scale,
+                                        rrt[ref_idx] / rt_tol]))
+        cand = tree.query_ball_point(
+            np.column_stack([cen / scale, qrt[idx] / rt_tol]),
+            r=np.maximum(wid / scale, 1.0) * (1 + 1e-9), p=np.inf,
+            return_sorted=True)
+
+        cnt = np.fromiter(map(len, cand), dtype=np.int64, count=len(idx))
+        qry_idx = np.repeat(idx, cnt)
+        pos = ref_idx[np.fromiter(itertools.chain.from_iterable(cand),
+                                  dtype=np.int64, count=cnt.sum())]
+
+        # exact check on window boundary
+        keep = (
+            (mass[pos] >= lo[qry_idx]) & (mass[pos] <= hi[qry_idx])
+            & (np.abs(rrt[pos] - qrt[qry_idx]) <= rt_tol)
+        )
+        res.append((qry_idx[keep], pos[keep]))
+
+    qry_idx = np.concatenate([x[0] for x in res])
+    pos = np.concatenate([x[1] for x in res])
+    idx = np.lexsort((pos, qry_idx))
+
+    return qry_idx[idx], pos[idx]
+
+
+# -------------------------------------------------------------------------
+# Interval join of mass windows and sorted mass with a linear sweep
+def _sweep_join(lo, hi, mass):
+    """
+    Interval join of mass windows and sorted mass with a linear sweep.
+
+    Windows are visited in ascending order of their bounds, so both bounds
+    are resolved by one forward pass over `mass` and the join costs
+    O(n + m + k) after sorting, where k is the number of hits. The sweep is
+    compiled with `numba` if it is installed, otherwise windows are resolved
+    with `numpy.searchsorted`.
+
+    Parameters
+    ----------
+    lo : ndarray
+        Lower bounds of mass windows (inclusive).
+    hi : ndarray
+        Upper bounds of mass windows (inclusive).
+    mass : ndarray
+        Mass values in ascending order.
+
+    Returns
+    -------
+    qry_idx : ndarray
+        Window index of each hit.
+    pos : ndarray
+        Position in `mass` of each hit. The same as `_search_mass`.
+    """
+
+    if njit is None:
+        return _search_mass(lo, hi, mass)
+
+    lo = np.array(lo, dtype=np.float64)
+    hi = np.array(hi, dtype=np.float64)
+    mass = np.ascontiguousarray(mass, dtype=np.float64)
+
+    # missing window never matches
+    bad = np.isnan(lo) | np.isnan(hi)
+    lo[bad] = np.inf
+    hi[bad] = -np.inf
+    lo_order = np.argsort(lo, kind="stable")
+    hi_order = np.argsort(hi, kind="stable")
+
+    return _sweep_kernel(lo, hi, mass, lo_order, hi_order)
+
+
+# -------------------------------------------------------------------------
+# Sweep kernel of `_sweep_join`
+def _sweep_kernel(lo, hi, mass, lo_order, hi_order):
+    """Internal function for `_sweep_join`."""
+
+    n = len(lo)
+    m = len(mass)
+
+    # first position not less than lower bound
+    start = np.empty(n, dtype=np.int64)
+    j = 0
+    for i in lo_order:
+        while j < m and mass[j] < lo[i]:
+            j += 1
+        start[i] = j
+
+    # first position greater than upper bound
+    stop = np.empty(n, dtype=np.int64)
+    j = 0
+    for i in hi_order:
+        while j < m and mass[j] <= hi[i]:
+            j += 1
+        stop[i] = j
+
+    # emit (window, position) pairs
+    total = 0
+    for i in range(n):
+        if stop[i] > start[i]:
+            total += stop[i] - start[i]
+    qry_idx = np.empty(total, dtype=np.int64)
+    pos = np.empty(total, dtype=np.int64)
+    k = 0
+    for i in range(n):
+        for j in range(start[i], stop[i]):
+            qry_idx[k] = i
+            pos[k] = j
+            k += 1
+
+    return qry_idx, pos
+
+
+if njit is not None:
+    _sweep_kernel = njit(cache=True, nogil=True)(_sweep_kernel)
+
+
+# -------------------------------------------------------------------------
+# Build compound match table from matched reference rows
+def _match_tab(ref, ref_idx, peak_id, mz, exact_mass, adduct=None):
+    """
+    Build compound match table from matched reference rows.
+
+    Parameters
+    ----------
+    ref : DataFrame
+        Reference library.
+    ref_idx : ndarray
+        Row positions of matched reference records.
+    peak_id : ndarray
+        Peak names of matches.
+    mz : ndarray
+        Peak m/z values of matches.
+    exact_mass : ndarray
+        Exact mass of matches.
+    adduct : ndarray
+        Adduct labels of matches. If None, no `adduct` column is added.
+
+    Returns
+    -------
+    DataFrame
+        A compound match table with the reference columns followed by
+        `adduct` (if any), `id`, `mz` and `ppm_error`.
+    """
+
+    res = ref.take(ref_idx).reset_index(drop=True)
+
+    # missing strings are None as fetched from sqlite
+    for col in res.select_dtypes(include="object").columns:
+        res[col] = res[col].astype(object).where(res[col].notnull(), None)
+
+    res["exact_mass"] = exact_mass
+    if adduct is not None:
+        res["adduct"] = adduct
+    res["id"] = peak_id
+    res["mz"] = mz
+    res["ppm_error"] = (mz - exact_mass) / (exact_mass * 0.000001)
+
+    return res
+
+
+# -------------------------------------------------------------------------
+# wl-24-04-2024, Wed: compound match
+# wl-06-08-2024, Tue: The only requirement from 'ref' is 'exact_mass'
+# wl-07-08-2024, Wed: 'adduct' in peak has nothing to do with lib_adducts.
+def comp_match_mass_add(peak, ppm, ref, lib_adducts, engine="numpy",
+                        n_jobs=1, rt_tol=None):
+    """
+    Compound match.
+
+    This function performs compound match against exact mass in reference
+    library and adducts library.
+
+    Parameters
+    ----------
+    peak : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    ppm : float
+        A value for ppm.
+    ref : DataFrame
+        A pandas data frame of reference library which must have
+        `exact_mass` column.
+    lib_adducts : DataFrame
+        A pandas data frame of adducts library which must have `exact_mass`
+        column.
+    engine : {'numpy', 'sweep', 'sqlite'}
+        Matching engine:
+        * numpy : build mass windows of all peaks and adducts at once and
+          search them against sorted exact mass in a single vectorised call
+        * sweep : as 'numpy' but resolve windows with one linear sweep over
+          sorted exact mass. It is compiled with `numba` if installed.
+        * sqlite : query an in-memory sqlite table for each peak and adduct
+    n_jobs : int
+        Number of processes for matching. See `comp_match_mass`.
+    rt_tol : float
+        Tolerance of retention time. See `comp_match_mass`.
+
+    Returns
+    -------
+    DataFrame
+        A pandas dataframe of compound match table.
+
+    See Also
+    --------
+    com_match_mass : Return compound match table. This function does not use
+        adducts library to adjust compound match.
+    """
+
+    if engine in ("numpy", "sweep"):
+        return _comp_match_np(peak, ppm, ref, lib_adducts, engine=engine,
+                              n_jobs=n_jobs, rt_tol=rt_tol)
+    elif engine == "sqlite":
+        return _comp_match_mass_add_sql(peak, ppm, ref, lib_adducts,
+                                        rt_tol=rt_tol)
+    else:
+        raise ValueError("Engine must be 'numpy', 'sweep' or 'sqlite'.")
+
+
+# -------------------------------------------------------------------------
+# wl-24-04-2024, Wed: compound match
+# Convert data frame 'ref' to sqlite for speedy query
+def _comp_match_mass_add_sql(peak, ppm, ref, lib_adducts, rt_tol=None):
+    """Internal function for `comp_match_mass_add` with sqlite engine."""
+
+    name, mz = _peak_arr(peak)
+    lib = _lib_arr(lib_adducts)
+    _, add_mass, charge = lib
+    ref = ref[~_ref_dup(ref, adduct=True)].reset_index(drop=True)
+    rt = _rt_arr(peak, ref, np.arange(len(ref)), rt_tol)
+    con = _ref_sql(ref, rt=rt is not None)
+    cur = con.cursor()
+    query, rt_tol = _ref_sql_query(rt)
+
+    # annotation/match compounds. Only row positions are fetched.
+    pk_idx, pos, add_idx = [], [], []
+    for i, x in enumerate(mz):
+        min_mz, max_mz = _cal_mass_tol(x, ppm)
+        pk_rt = None if rt is None else _sql_val(rt[0][i])
+        for j in range(len(add_mass)):
+            if min_mz - add_mass[j] < 0.5:
+                continue
+
+            min = (min_mz - add_mass[j]) * charge[j]
+            max = (max_mz - add_mass[j]) * charge[j]
+
+            cur.execute(query, (min, max) +
+                        ((pk_rt, pk_rt, rt_tol) if rt else ()))
+            rec = [x[0] for x in cur.fetchall()]
+            pos.extend(rec)
+            pk_idx.extend([i] * len(rec))
+            add_idx.extend([j] * len(rec))
+
+    con.close()
+
+    return _match_res(ref, np.arange(len(ref)),
+                      ref["exact_mass"].to_numpy(dtype=float), name, mz,
+                      np.array(pk_idx, dtype=np.int64),
+                      np.array(pos, dtype=np.int64), lib,
+                      np.array(add_idx, dtype=np.int64))
+
+
+# -------------------------------------------------------------------------
+# wl-22-04-2024, Mon: calculate mass tolerance/range based on ppm
+# wl-11-10-2024, Fri: Review
+def _cal_mass_tol(mass, ppm):
+    """
+    Calculate m/z value tolerance/range.
+
+    Parameters
+    ----------
+    mass : float
+        A mass value.
+    ppm : float
+        ppm value.
+
+    Returns
+    -------
+    min_tol : float
+        Minimal tolerance.
+    max_tol : float
+        Maximal tolerance.
+    """
+
+    delta = 0.000001
+    min_tol = (1 - delta * ppm) * mass
+    max_tol = (1 + delta * ppm) * mass
+
+    return min_tol, max_tol
+
+
+# -----------------------------------------------------------------------
+# Chemical formula syntax of `pyteomics`
+_ATOM = r'([A-Z][a-z+]*(?:\[\d+\])?)([+-]?\d+)?'
+_FORMULA = r'^(?:{})*$'.format(_ATOM)
+_ISOTOPE = r'^([A-Z][a-z+]*)(?:\[(\d+)\])?$'
+
+
+# -----------------------------------------------------------------------
+# wl-22-04-2024, Mon: calculate molecular formula' exact mass
+# wl-23-04-2024, Tue: fix a bug. use argument names for 'calculate_mass'
+# wl-06-08-2024, Tue: exception handling. how to catch user-defined error:
+#  PyteomicsError?
+# Calculate all formulas with one product of element count matrix and mass
+#  vector instead of 'calculate_mass' for each formula.
+def _cal_mass(formula, mass_data):
+    """
+    Calculate molecular formula's exact mass
+
+    Parameters
+    ----------
+    formula : Series
+        Strings with chemical formula.
+    mass_data : OrderedDict
+        A dict with the masses of the chemical elements.
+
+    Returns
+    -------
+    ndarray
+        Mass values. NaN if a formula can not be parsed or has elements or
+        isotopes not in `mass_data`.
+
+    Notes
+    -----
+    Formulas are parsed as `pyteomics.mass.calculate_mass` does. Atoms of
+    all formulas are put into a sparse matrix of formulas by isotopes and
+    masses are its product with the vector of isotope masses. Masses may
+    differ from `calculate_mass` in the last bit because of summation
+    order.
+    """
+
+    formula = pd.Series(formula, dtype=object).map(str)
+    res = np.full(len(formula), np.nan)
+    valid = np.flatnonzero(formula.str.match(_FORMULA).to_numpy(dtype=bool))
+    res[valid] = 0.0
+
+    # parse atoms of all formulas in one go. Formulas are separated by a
+    # space which counts the formula of each atom.
+    tok = re.findall("( )|" + _ATOM, " ".join(formula.iloc[valid]))
+    tok = pd.DataFrame(tok, columns=["sep", "label", "num"], dtype=object)
+    row = valid[np.cumsum((tok["sep"] == " ").to_numpy())]
+    atom = (tok["sep"] == "").to_numpy()
+    if not atom.any():
+        return res
+    row = row[atom]
+    col, key = pd.factorize(tok["label"][atom])
+    num = tok["num"][atom].replace("", "1").astype(float).to_numpy()
+
+    # mass vector of isotopes
+    iso_mass = np.full(len(key), np.nan)
+    for i, x in enumerate(key):
+        elem, iso = re.match(_ISOTOPE, x).groups()
+        iso_mass[i] = mass_data.get(elem, {}).get(int(iso or 0),
+                                                  (np.nan,))[0]
+    miss = np.isnan(iso_mass)
+
+    # formulas by isotopes count matrix
+    mat = coo_matrix((num, (row, col)), shape=(len(formula), len(key)))
+    res[valid] = (mat.tocsr() @ np.where(miss, 0.0, iso_mass))[valid]
+
+    # unknown element or isotope
+    res[np.unique(row[miss[col]])] = np.nan
+
+    return res
+
+
+# -----------------------------------------------------------------------
+# wl-08-08-2024, Thu: adjust molecular formula' exact mass
+# wl-06-11-2024, Wed: Re-write
+# Vectorised over all rows instead of row-wise 'apply'
+def _adj_mass(mass, adduct, add_dict):
+    """
+    Adjust mass based on adduct library
+
+    Parameters
+    ----------
+    mass : Series
+        Mass values to be adjusted.
+    adduct : Series
+        Strings of adduct. They are used to match against 'add_dict'.
+    add_dict : dict
+        A dictionary of adducts library.
+
+    Returns
+    -------
+    ndarray
+        Adjusted mass. Mass of adducts not in 'add_dict' is unchanged.
+    """
+
+    mass = np.asarray(mass, dtype=float)
+    hit = adduct.isin(list(add_dict)).to_numpy()
+    adj = mass.copy()
+    adj[hit] += adduct[hit].map(add_dict).to_numpy(dtype=float)
+
+    return adj
+
+
+# -----------------------------------------------------------------------
+# Parse NIST database
+def _parse_nist_database(fn, skip_lines=10):
+    """
+    Parse NIST database.
+
+    This function is called by `_nist_database_to_pyteomics`.
+
+    Parameters
+    ----------
+    fn : str
+        Text file (NISTs Linearized ASCII Output)
+    skip_lines : integer
+        The number of lines of the data file to skip before beginning to
+        read data.
+
+    Yields
+    ------
+    Ordered dictionary
+        Containing the parsed records
+
+    Notes
+    -----
+    This function is from python package `beamspy`.
+    """
+
+    with open(fn, "r") as inp:
+        for i in range(skip_lines):
+            inp.readline()
+        for e in inp.read().split("\n\n"):
+            record = OrderedDict()
+            for line in e.strip().split("\n"):
+                kv = line.split(" =")
+                if kv[0] == "Relative Atomic Mass":
+                    record[kv[0]] = re.findall(r'\d+(?:\.\d+)?', kv[1])
+                    record[kv[0]][0] = float(record[kv[0]][0])
+                    record[kv[0]][1] = int(record[kv[0]][1])
+
+                elif kv[0] == "Isotopic Composition":
+                    matches = re.findall(r'\d+(?:\.\d+)?', kv[1])
+                    if len(matches) > 0:
+                        record[kv[0]] = matches
+                        if len(matches) > 1:
+                            record[kv[0]][0] = float(record[kv[0]][0])
+                            record[kv[0]][1] = int(record[kv[0]][1])
+                        else:
+                            record[kv[0]] = [float(record[kv[0]][0]), None]
+                    else:
+                        record[kv[0]] = [0.0, None]
+                elif kv[0] == "Atomic Number" or kv[0] == "Mass Number":
+                    record[kv[0]] = int(kv[1])
+                elif kv[0] == "Standard Atomic Weight":
+                    matches = re.findall(r'\d+(?:\.\d+)?', kv[1])
+                    record[kv[0]] = matches
+                else:
+                    record[kv[0]] = kv[1].strip()
+            yield record
+
+
+# -----------------------------------------------------------------------
+# Convert NIST database to pyteomics mass data
+def _nist_database_to_pyteomics(fn, skip_lines=10):
+    """
+    Convert NIST database to dict for calculation of mass
+
+    Parameters
+    ----------
+    fn : str
+        Text file (NISTs Linearized ASCII Output)
+    skip_lines : integer
+        The number of lines of the data file to skip before beginning to
+        read data.
+
+    Returns
+    -------
+    dict
+        Ordered dictionary containing NIST records compatible with
+        `Pyteomics`.
+
+    Notes
+    -----
+    This function is from python package `beamspy`.
+    """
+
+    def add_record(r, nm):
+        if r["Atomic Symbol"] not in nm:
+            # update after all records have been added
+            nm[r["Atomic Symbol"]] = OrderedDict([(0, (0.0, 0.0))])
+            nm[r["Atomic Symbol"]][r["Mass Number"]] = (
+                r["Relative Atomic Mass"][0], r["Isotopic Composition"][0])
+        else:
+            nm[r["Atomic Symbol"]][r["Mass Number"]] = (
+                r["Relative Atomic Mass"][0], r["Isotopic Composition"][0])
+        return nm
+
+    def order_composition_by_hill(composition):
+        symbols = set(composition)
+        if 'C' in symbols:
+            symbols.remove('C')
+            yield 'C'
+            if 'H' in symbols:
+                symbols.remove('H')
+                yield 'H'
+        for symbol in sorted(symbols):
+            yield symbol
+
+    lib = OrderedDict()
+    for record in _parse_nist_database(fn, skip_lines=skip_lines):
+        if record["Atomic Symbol"] in ["D", "T"]:
+            lib = add_record(record, lib)
+            record["Atomic Symbol"] = "H"
+            lib = add_record(record, lib)
+        else:
+            lib = add_record(record, lib)
+
+    for element in list(lib.keys()):
+        lib_sorted = sorted(lib[element].items(),
+                            key=lambda e: e[1][1], reverse=True)
+        if lib_sorted[0][1][0] > 0.0:
+            lib[element][0] = (lib_sorted[0][1][0], 1.0)
+        elif len(lib_sorted) == 2:
+            lib[element][0] = (lib_sorted[1][1][0], 1.0)
+        else:
+            del lib[element]
+
+    es = list(order_composition_by_hill(lib.keys()))
+
+    return OrderedDict((k, lib[k]) for k in es)
+
+
+# -----------------------------------------------------------------------
+# Get NIST element mass table, parsed once per process
+@functools.lru_cache(maxsize=None)
+def _nist_mass():
+    """
+    Get NIST element mass table for `pyteomics`.
+
+    The table is parsed once per process. It is also saved as JSON in the
+    cache directory (see `lamp.utils.get_cache_dir`) together with the
+    SHA-256 digest of `lib/nist_database.txt`, so other processes load it
+    without parsing as long as the database file is unchanged.
+
+    Returns
+    -------
+    OrderedDict
+        Masses of the chemical elements. It is shared and must not be
+        modified.
+    """
+
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'lib', 'nist_database.txt')
+    digest = file_hash(fn)
+    cache = os.path.join(get_cache_dir(), "nist_mass.json")
+
+    # load precompiled table if it is built from the same database
+    try:
+        with open(cache) as f:
+            obj = json.load(f)
+        if obj.get("sha256") == digest:
+            return OrderedDict(
+                (k, OrderedDict((int(i), tuple(x)) for i, x in v))
+                for k, v in obj["mass"]
+            )
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    nist_mass = _nist_database_to_pyteomics(fn)
+
+    # write atomically. Failure only costs parsing next time.
+    obj = {
+        "sha256": digest,
+        "mass": [[k, [[i, list(x)] for i, x in v.items()]]
+                 for k, v in nist_mass.items()],
+    }
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache),
+                                   suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(obj, f)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+
+    return nist_mass
+
+
+# -----------------------------------------------------------------------
+# Process-level LRU cache of formula masses
+_mass_cache = OrderedDict()
+_mass_cache_info = {"maxsize": 2 ** 20, "rows": 0, "unique": 0, "hits": 0,
+                    "misses": 0}
+
+
+# -----------------------------------------------------------------------
+# Calculate exact mass of formulas with unique formulas and cache
+def _formula_mass(formula):
+    """
+    Calculate exact mass of formulas with unique formulas and cache.
+
+    Formulas are de-duplicated first. Masses of unique formulas are looked
+    up in a least recently used cache kept for the process and only the
+    missed ones are calculated by `_cal_mass`.
+
+    Parameters
+    ----------
+    formula : Series
+        Strings with chemical formula.
+
+    Returns
+    -------
+    ndarray
+        Mass values in the order of `formula`.
+
+    See Also
+    --------
+    mass_cache_info : Statistics of the cache.
+    """
+
+    code, uni = pd.factorize(pd.Series(formula, dtype=object).map(str))
+    res = np.empty(len(uni))
+    miss = []
+    for i, x in enumerate(uni):
+        if x in _mass_cache:
+            _mass_cache.move_to_end(x)
+            res[i] = _mass_cache[x]
+        else:
+            miss.append(i)
+
+    if miss:
+        res[miss] = _cal_mass(uni[miss], _nist_mass())
+        _mass_cache.update(zip(uni[miss], res[miss]))
+        while len(_mass_cache) > _mass_cache_info["maxsize"]:
+            _mass_cache.popitem(last=False)
+
+    _mass_cache_info["rows"] += len(code)
+    _mass_cache_info["unique"] += len(uni)
+    _mass_cache_info["hits"] += len(uni) - len(miss)
+    _mass_cache_info["misses"] += len(miss)
+
+    return res[code]
+
+
+# -----------------------------------------------------------------------
+# Statistics of formula mass cache
+def mass_cache_info():
+    """
+    Get statistics of formula mass cache.
+
+    Returns
+    -------
+    dict
+        `rows` is the number of formulas passed to `cal_mass` and `unique`
+        the number of unique formulas among them. `hits` and `misses` count
+        unique formulas found or not in the cache. `size` and `maxsize`
+        are the current and maximal number of cached formulas.
+    """
+
+    return dict(_mass_cache_info, size=len(_mass_cache))
+
+
+# -----------------------------------------------------------------------
+# Clear formula mass cache
+def mass_cache_clear():
+    """Clear formula mass cache and its statistics."""
+
+    _mass_cache.clear()
+    for k in ("rows", "unique", "hits", "misses"):
+        _mass_cache_info[k] = 0
+
+
+# -----------------------------------------------------------------------
+# wl-22-04-2024, Mon: calculate exact mass for a reference data frame
+# wl-07-08-2024, Wed: problem if adduct does not match in adduct library
+# wl-08-08-2024, Thu: fix a bug in mass adjustment
+def cal_mass(df, lib_adducts=None):
+    """
+    Calculate exact mass for an reference data frame.
+
+    This function calculates exact mass using NIST database. If the
+    reference file has 'adduct' column and user provides a adducts library,
+    the exact mass will be adjust according to the adducts library.
+
+    Parameters
+    ----------
+    df : DataFrame
+        An reference data frame. It must have a column called
+        'molecular_formula'.
+    lib_adducts : DataFrame
+        Adducts library in data frame format for mass adjustment. Only for
+        'df' has 'ion_type' column.
+
+    Returns
+    -------
+    DataFrame
+        Reference dataframe with exact mass.
+    """
+
+    # get exact mass of each unique formula once
+    df = (
+        df
+        .assign(exact_mass=lambda x: _formula_mass(x.molecular_formula))
+    )
+
+    # adjust exact mass or not
+    if ("adduct" in df.columns) and (lib_adducts is not None):
+        # convert 2-column df into dictionary for speedy query
+        add = df2dict(lib_adducts.iloc[:, 0:2])
+        df = (
+            df
+            .assign(exact_mass=lambda x:
+                    _adj_mass(x.exact_mass, x.adduct, add))
+        )
+
+    return df
+
+
+# ------------------------------------------------------------------------
+# wl-22-04-2024, Mon: load reference file for compound annotation
+# wl-08-08-2024, Thu: use 'cal_mass' function
+# wl-10-09-2024, Tue: remove empty rows and columns
+# wl-11-09-2024, Wed: rename 'name' as 'molecular_name' in case 'name'
+#   conflicts with data set's peak 'name'.
+# wl-09-10-2024, Wed: set 'filename' default value
+# wl-23-10-2024, Wed: support Excel
+# wl-30-10-2024, Wed: add ion_mode
+def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
+             lib_adducts=None, cache=True):
+    """
+    Load reference for compound annotation
+
+    Parameters
+    ----------
+    fn : str
+        Full path for an reference file. If empty, use default reference
+        file. This file must have `formula` or `molecular_formula` column.
+        The current supported file formats are text formats (csv, tsv, txt
+        and dat), Excel formats (xls, xlsx) and reference index built by
+        `write_index`.
+    ion_mode : str
+        A string for ion mode, "pos" or "neg".
+    sheet_name: str or int
+        This argument is used for Excel file format. Strings are used for
+        sheet names. Integers are used in zero-indexed sheet positions
+        (chart sheets do not count as a sheet position).
+
+        Available cases:
+
+        * Defaults to ``0``: 1st sheet as a `DataFrame`
         * ``1``: 2nd sheet as a `DataFrame`
         * ``"Sheet1"``: Load sheet with name "Sheet1"
 
@@ -792,6 +1887,8 @@ def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
     lib_adducts : DataFrame
         Adducts library in data frame format for mass adjustment. Only for
         'fn' has 'ion_type' column.
+    cache : bool
+        Use the on-disk cache of prepared references or not.
 
     Returns
     -------
@@ -800,9 +1897,30 @@ def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
 
     Notes
     -----
-    This function will remove reference empty rows and columns.
+    This function will remove reference empty rows and columns. A reference
+    index is memory-mapped and already tidied, so only the ion mode is
+    checked and exact mass calculated if the index was built without it.
+
+    A prepared reference file is cached as a reference index under
+    `lamp.utils.get_cache_dir`, keyed by the content hash of the file and
+    adducts library, ion mode and `calc`. Later calls with the same inputs
+    load the cached index instead, which keeps the row order, row labels
+    and column types of the prepared reference. Least recently used
+    entries are removed when the cache exceeds
+    `lamp.utils.get_cache_size`.
     """
 
+    # load reference index
+    if is_index(fn):
+        meta = read_index_meta(fn)
+        if ion_mode and meta["ion_mode"] and ion_mode != meta["ion_mode"]:
+            raise ValueError("Reference index is built for ion mode '{}'."
+                             .format(meta["ion_mode"]))
+        df = read_index(fn)
+        if calc and not meta["calc"]:
+            df = cal_mass(df, lib_adducts)
+        return df
+
     # load default reference library
     if not fn:
         path = 'lib/GSMM_LAMP_ReferenceFile_v1_281024.xlsx'
@@ -813,6 +1931,15 @@ def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
         #     os.path.dirname(os.path.abspath(__file__)), path
         # )
 
+    # load prepared reference from cache
+    key = None
+    if cache:
+        key = _ref_cache_key(fn, ion_mode, sheet_name, sep, calc,
+                             lib_adducts)
+        df = _read_ref_cache(key)
+        if df is not None:
+            return df
+
     ext = os.path.splitext(fn)[1][1:]
     if ext in ['xls', 'xlsx']:
         df = pd.read_excel(fn, sheet_name=sheet_name, header=0)
@@ -858,9 +1985,82 @@ def read_ref(fn="", ion_mode="pos", sheet_name=0, sep="\t", calc=False,
     if calc or ('exact_mass' not in df.columns):
         df = cal_mass(df, lib_adducts)
 
+    if key:
+        _write_ref_cache(key, df, lib_adducts, ion_mode, calc, fn)
+
     return df
 
 
+# -------------------------------------------------------------------------
+# Load several reference libraries into one reference
+def read_refs(fns, ion_mode="pos", sheet_name=0, sep="\t", calc=False,
+              lib_adducts=None, cache=True):
+    """
+    Load several reference libraries into one reference.
+
+    Each library is loaded by `read_ref` and tagged with its source in
+    column `library`, so all libraries can be matched against one merged
+    mass index in a single pass.
+
+    Parameters
+    ----------
+    fns : list of str
+        Full paths of reference files or reference indexes. An empty string
+        means the default reference file.
+    ion_mode : str
+        A string for ion mode, "pos" or "neg".
+    sheet_name: str or int
+        Sheet of Excel file. See `read_ref`.
+    sep : str
+        Character to treat as the delimiter. It is used for text file
+        format.
+    calc : bool
+        Calculate exact mass or not.
+    lib_adducts : DataFrame
+        Adducts library in data frame format for mass adjustment.
+    cache : bool
+        Use the on-disk cache of prepared references or not.
+
+    Returns
+    -------
+    DataFrame
+        Reference dataframe with exact mass and `library` column.
+
+    Notes
+    -----
+    The library name is the file name without extension. A reference index
+    which already has `library` column keeps its own tags. Columns missing
+    in some libraries are filled with missing values.
+    """
+
+    names = [_lib_name(x) for x in fns]
+    if len(set(names)) < len(names):
+        raise ValueError("Reference libraries must have different names.")
+
+    refs = []
+    for fn, name in zip(fns, names):
+        df = read_ref(fn=fn, ion_mode=ion_mode, sheet_name=sheet_name,
+                      sep=sep, calc=calc, lib_adducts=lib_adducts,
+                      cache=cache)
+        # keep tags of an index built from several libraries
+        if "library" not in df.columns:
+            df = df.assign(library=name)
+        refs.append(df)
+
+    return pd.concat(refs, ignore_index=True)
+
+
+# -------------------------------------------------------------------------
+# Get library name from reference path
+def _lib_name(fn):
+    """Internal function to get library name of a reference file."""
+
+    if not fn:
+        fn = 'GSMM_LAMP_ReferenceFile_v1_281024.xlsx'
+
+    return os.path.splitext(os.path.basename(os.path.normpath(fn)))[0]
+
+
 # -------------------------------------------------------------------------
 # wl-24-12-2023, Sun: get library in data frame format
 # wl-09-10-2024, Wed: set 'filename' default value
@@ -873,6 +2073,7 @@ def read_lib(fn="", ion_mode="pos", sheet_name=0, sep="\t"):
     ----------
     fn : str
         Full path for an library file. if empty, use default library file.
+        It can also be a reference index built with an adducts library.
     ion_mode : str
         A string for ion mode, "pos" or "neg".
     sheet_name: str or int
@@ -895,6 +2096,16 @@ def read_lib(fn="", ion_mode="pos", sheet_name=0, sep="\t"):
         A library data frame.
     """
 
+    # load adducts library from reference index
+    if is_index(fn):
+        meta = read_index_meta(fn)
+        if not meta["adducts"]:
+            raise ValueError("Reference index has no adducts library.")
+        if ion_mode and meta["ion_mode"] and ion_mode != meta["ion_mode"]:
+            raise ValueError("Reference index is built for ion mode '{}'."
+                             .format(meta["ion_mode"]))
+        return read_index(fn, name="adducts")
+
     # load default library
     if not fn:
         path = 'lib/adducts.txt'
@@ -926,6 +2137,423 @@ def read_lib(fn="", ion_mode="pos", sheet_name=0, sep="\t"):
     return df
 
 
+# Version of the on-disk index format
+_INDEX_VERSION = 2
+
+
+# -------------------------------------------------------------------------
+# Write reference library into an on-disk index
+def write_index(fn, ref, lib_adducts=None, ion_mode="", calc=False,
+                source="", sort=True):
+    """
+    Write reference library into an on-disk index.
+
+    The index is a directory with a `meta.json` sidecar and one directory
+    per table, in which each column is stored in numpy `npy` format. The
+    reference is sorted by exact mass if `sort` is True, otherwise its rows
+    and row labels are kept as they are. Numeric columns are memory-mapped
+    by `read_index` without copying, so one index can be loaded quickly
+    and its pages are shared by concurrent jobs. Text columns are stored
+    compactly as one UTF-8 blob with offsets. See `_write_table`.
+
+    Parameters
+    ----------
+    fn : str
+        Directory of the index. It will be created if it does not exist.
+    ref : DataFrame
+        Reference library returned by `read_ref`.
+    lib_adducts : DataFrame
+        Adducts library returned by `read_lib`. If None, the index has no
+        adducts library.
+    ion_mode : str
+        Ion mode of `ref` and `lib_adducts`.
+    calc : bool
+        Whether exact mass of `ref` was calculated.
+    source : str
+        Reference file which `ref` was loaded from.
+    sort : bool
+        Sort reference by exact mass or not.
+
+    Returns
+    -------
+    dict
+        Metadata of the index.
+    """
+
+    os.makedirs(fn, exist_ok=True)
+
+    # sort by exact mass. Missing mass goes to the end.
+    if sort:
+        ref = ref.iloc[np.argsort(ref["exact_mass"].to_numpy(dtype=float),
+                                  kind="stable")].reset_index(drop=True)
+
+    meta = {
+        "format": "lamp-index",
+        "version": _INDEX_VERSION,
+        "lamp": lamp.__version__,
+        "source": source,
+        "ion_mode": ion_mode,
+        "calc": bool(calc),
+        "sorted": bool(sort),
+        "adducts": lib_adducts is not None,
+        "tables": {},
+    }
+
+    tabs = {"reference": ref}
+    if lib_adducts is not None:
+        tabs["adducts"] = lib_adducts
+    for name, df in tabs.items():
+        meta["tables"][name] = _write_table(os.path.join(fn, name), df)
+
+    with open(os.path.join(fn, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    return meta
+
+
+# -------------------------------------------------------------------------
+# Read a table from an on-disk reference index
+def read_index(fn, name="reference", mmap_mode="r"):
+    """
+    Read a table from an on-disk reference index.
+
+    Parameters
+    ----------
+    fn : str
+        Directory of the index built by `write_index`.
+    name : {'reference', 'adducts'}
+        Table to read.
+    mmap_mode : {None, 'r', 'c'}
+        Memory-map mode passed to `numpy.load`.
+
+    Returns
+    -------
+    DataFrame
+        Reference library, sorted by exact mass unless the index was
+        written with `sort=False`, or adducts library.
+        Numeric columns are views of the memory-mapped files.
+    """
+
+    meta = read_index_meta(fn)
+    if name not in meta["tables"]:
+        raise ValueError("Reference index has no '{}' table.".format(name))
+
+    return _read_table(os.path.join(fn, name), meta["tables"][name],
+                       mmap_mode)
+
+
+# -------------------------------------------------------------------------
+# Read metadata of an on-disk reference index
+def read_index_meta(fn):
+    """
+    Read metadata of an on-disk reference index.
+
+    Parameters
+    ----------
+    fn : str
+        Directory of the index built by `write_index`.
+
+    Returns
+    -------
+    dict
+        Metadata of the index.
+    """
+
+    with open(os.path.join(fn, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    if meta.get("format") != "lamp-index":
+        raise ValueError("Not a lamp reference index: {}".format(fn))
+    if meta.get("version") != _INDEX_VERSION:
+        raise ValueError("Reference index was built by another version of "
+                         "lamp. Please build it again: {}".format(fn))
+
+    return meta
+
+
+# -------------------------------------------------------------------------
+# Check a path is an on-disk reference index
+def is_index(fn):
+    """
+    Check a path is an on-disk reference index.
+
+    Parameters
+    ----------
+    fn : str
+        A path.
+
+    Returns
+    -------
+    bool
+        True if `fn` is a directory with `meta.json`.
+    """
+
+    return bool(fn) and os.path.isfile(os.path.join(fn, "meta.json"))
+
+
+# -------------------------------------------------------------------------
+# Write a data frame into a directory of column files
+def _write_table(path, df):
+    """
+    Write a data frame into a directory of column files.
+
+    Columns of numpy numeric, boolean and datetime types are saved as they
+    are. Other columns must hold strings, booleans, integers or floats,
+    with missing values. They are saved as one UTF-8 blob, character
+    offsets of values and type codes, see `_write_obj`. The row index is
+    saved the same way unless it is the default range index.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the table. It will be created.
+    df : DataFrame
+        A data frame.
+
+    Returns
+    -------
+    dict
+        Specification of the table for `_read_table`.
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    cols = []
+    for i in range(df.shape[1]):
+        spec = _write_col(path, "c{}".format(i), df.iloc[:, i])
+        cols.append(dict(spec, name=str(df.columns[i])))
+
+    index = None
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        index = _write_col(path, "index", df.index.to_series())
+
+    return {"rows": len(df), "columns": cols, "index": index}
+
+
+# -------------------------------------------------------------------------
+# Read a data frame from a directory of column files
+def _read_table(path, spec, mmap_mode="r"):
+    """
+    Read a data frame from a directory of column files.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the table written by `_write_table`.
+    spec : dict
+        Specification of the table returned by `_write_table`.
+    mmap_mode : {None, 'r', 'c'}
+        Memory-map mode passed to `numpy.load`.
+
+    Returns
+    -------
+    DataFrame
+        A data frame. Numeric columns are not copied, so they are views of
+        memory-mapped files if `mmap_mode` is given.
+    """
+
+    res = {x["name"]: _read_col(path, x, mmap_mode) for x in spec["columns"]}
+    index = None
+    if spec["index"] is not None:
+        index = _read_col(path, spec["index"], mmap_mode)
+    else:
+        index = pd.RangeIndex(spec["rows"])
+
+    return pd.DataFrame(res, index=index, columns=list(res), copy=False)
+
+
+# -------------------------------------------------------------------------
+# Write a column into files
+def _write_col(path, stem, val):
+    """Internal function for `_write_table`. Returns column spec."""
+
+    if isinstance(val.dtype, np.dtype) and val.dtype.kind in "biufcmM":
+        np.save(os.path.join(path, stem + ".npy"), val.to_numpy(),
+                allow_pickle=False)
+        return {"kind": "array", "dtype": str(val.dtype), "file": stem}
+
+    if val.dtype != object:
+        raise ValueError("Column type is not supported: {}"
+                         .format(val.dtype))
+    _write_obj(os.path.join(path, stem), val.to_list())
+
+    return {"kind": "object", "dtype": "object", "file": stem}
+
+
+# -------------------------------------------------------------------------
+# Read a column from files
+def _read_col(path, spec, mmap_mode="r"):
+    """Internal function for `_read_table`. Returns an array."""
+
+    fn = os.path.join(path, spec["file"])
+    if spec["kind"] == "array":
+        res = np.load(fn + ".npy", mmap_mode=mmap_mode, allow_pickle=False)
+        return res.view(np.ndarray)
+
+    return _read_obj(fn)
+
+
+# -------------------------------------------------------------------------
+# Write values of an object column
+def _write_obj(fn, val):
+    """
+    Write values of an object column.
+
+    Values are converted to text and concatenated into one UTF-8 blob
+    (`fn.str.npy`). Character offsets of values (`fn.off.npy`) and their
+    type codes (`fn.type.npy`) restore them. `None` has empty text and
+    type code 0.
+    """
+
+    code = np.empty(len(val), dtype=np.uint8)
+    text = []
+    for i, x in enumerate(val):
+        if isinstance(x, (bool, np.bool_)):
+            code[i], x = 2, str(bool(x))
+        elif isinstance(x, (int, np.integer)):
+            code[i], x = 3, str(int(x))
+        elif isinstance(x, (float, np.floating)):
+            code[i], x = 4, repr(float(x))
+        elif x is None:
+            code[i], x = 0, ""
+        elif isinstance(x, str):
+            code[i] = 1
+        else:
+            raise ValueError("Value type is not supported: {}"
+                             .format(type(x).__name__))
+        text.append(x)
+
+    off = np.zeros(len(val) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in text], out=off[1:])
+    if off[-1] < 2**31:
+        off = off.astype(np.int32)
+    blob = np.frombuffer("".join(text).encode("utf-8"), dtype=np.uint8)
+
+    np.save(fn + ".str.npy", blob, allow_pickle=False)
+    np.save(fn + ".off.npy", off, allow_pickle=False)
+    np.save(fn + ".type.npy", code, allow_pickle=False)
+
+
+# -------------------------------------------------------------------------
+# Read values of an object column
+def _read_obj(fn):
+    """Internal function to read values written by `_write_obj`."""
+
+    text = np.load(fn + ".str.npy").tobytes().decode("utf-8")
+    off = np.load(fn + ".off.npy").tolist()
+    code = np.load(fn + ".type.npy").tolist()
+
+    conv = [lambda x: None, str, lambda x: x == "True", int, float]
+    res = np.empty(len(code), dtype=object)
+    res[:] = [conv[c](text[a:z])
+              for c, a, z in zip(code, off[:-1], off[1:])]
+
+    return res
+
+
+# -------------------------------------------------------------------------
+# Get cache key of a prepared reference
+def _ref_cache_key(fn, ion_mode, sheet_name, sep, calc, lib_adducts):
+    """
+    Get cache key of a prepared reference.
+
+    The key is the SHA-256 digest of lamp version, index format version,
+    content of reference file and adducts library, and arguments of
+    `read_ref`.
+    """
+
+    add = ""
+    if lib_adducts is not None:
+        h = hashlib.sha256(json.dumps(list(map(str, lib_adducts.columns)))
+                           .encode())
+        h.update(pd.util.hash_pandas_object(lib_adducts, index=False)
+                 .to_numpy().tobytes())
+        add = h.hexdigest()
+
+    key = json.dumps([lamp.__version__, _INDEX_VERSION, file_hash(fn), add,
+                      ion_mode, bool(calc), str(sheet_name), sep])
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# -------------------------------------------------------------------------
+# Read prepared reference from cache
+def _read_ref_cache(key):
+    """Internal function to read cached reference. None if not cached."""
+
+    path = os.path.join(get_cache_dir(), "ref", key)
+    if not is_index(path):
+        return None
+
+    try:
+        df = read_index(path)
+        # mark as recently used
+        os.utime(os.path.join(path, "meta.json"))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return df
+
+
+# -------------------------------------------------------------------------
+# Write prepared reference into cache
+def _write_ref_cache(key, ref, lib_adducts, ion_mode, calc, source):
+    """
+    Write prepared reference into cache.
+
+    The index is written into a temporary directory and renamed, so a
+    concurrent job never reads a partial entry. Failures are ignored.
+    """
+
+    root = os.path.join(get_cache_dir(), "ref")
+    tmp = None
+    try:
+        os.makedirs(root, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp", dir=root)
+        write_index(tmp, ref, lib_adducts=lib_adducts, ion_mode=ion_mode,
+                    calc=calc, source=source, sort=False)
+        os.rename(tmp, os.path.join(root, key))
+        tmp = None
+        _evict_cache(root, get_cache_size())
+    except (OSError, ValueError, TypeError):
+        pass
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+# -------------------------------------------------------------------------
+# Remove least recently used cache entries
+def _evict_cache(root, max_size):
+    """
+    Remove least recently used cache entries.
+
+    Parameters
+    ----------
+    root : str
+        Cache directory with one reference index per entry.
+    max_size : int
+        Maximal total size of entries in bytes.
+    """
+
+    ent = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(".") or not is_index(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(d, x))
+                   for d, _, files in os.walk(path) for x in files)
+        used = os.path.getmtime(os.path.join(path, "meta.json"))
+        ent.append((used, size, path))
+
+    total = sum(x[1] for x in ent)
+    for _, size, path in sorted(ent):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
 # --------------------------------------------------------------------------
 # wl-21-09-2022, Wed: Read file consisting of peak list and data matrix.
 # wl-02-09-2024, Mon: add 'dat' format for Galaxy data extension
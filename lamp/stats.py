@@ -1,6 +1,18 @@
+import warnings
+import functools
 import scipy
 import numpy as np
 import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from lamp.utils import parse_size, get_n_jobs
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 # -------------------------------------------------------------------------
@@ -8,7 +20,8 @@ import pandas as pd
 # differences for compound annotation.
 # wl-15-11-2024, Fri: minor changes
 def comp_corr_rt(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
-                 method="pearson", positive=True):
+                 method="pearson", positive=True, engine="tile",
+                 max_memory=None, dtype=None, n_jobs=1):
     """
     Get correlation coefficients, p-values and rt differences for compound
     annotation.
@@ -28,6 +41,33 @@ def comp_corr_rt(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
         Correlation methods, either "pearson" or "spearman".
     positive : bool
         Use positive correlation or not.
+    engine : {'tile', 'dense', 'sparse'}
+        Engine for correlation analysis:
+        * tile : a fused kernel over tiles of feature pairs which applies
+          all thresholds in one pass. See `_comp_corr_rt_tile`.
+        * dense : full correlation, p-value and rt difference matrices
+        * sparse : only pairs inside the retention time window. Memory
+          scales with the number of these pairs. See `_comp_corr_rt_sparse`.
+    max_memory : str or int
+        Memory budget of correlation in bytes or with unit, e.g. '4G'. It
+        sets the tile size of 'tile', the chunk size and the pair step of
+        'sparse' and the block size of `df_corr_pval` for 'dense'. If None,
+        use defaults.
+    dtype : {None, 'float32', 'float64'}
+        Type of matrix products of correlation. Default is 'float64'.
+        'float32' halves memory and is faster at the cost of precision. It
+        has no effect on 'sparse', which correlates one pair at a time.
+    n_jobs : int
+        Number of threads. Tiles, chunks or blocks of pairs are correlated
+        in parallel and merged in order, so the result is the same as with
+        one thread. The only exception is that `max_memory` is shared by
+        the threads, so their tiles are smaller, which may change the last
+        digits of coefficients. -1 means using all processors.
+
+    Notes
+    -----
+    Each pair of features is correlated over the samples observed in both
+    and its p-value is based on the number of these samples.
 
     Returns
     -------
@@ -35,13 +75,32 @@ def comp_corr_rt(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
         A table with differences of retention time, correlation
         coefficients, correlation p-values.
     """
+    if engine == "tile":
+        return _comp_corr_rt_tile(df, thres_rt, thres_corr, thres_pval,
+                                  method, positive, max_memory=max_memory,
+                                  dtype=dtype, n_jobs=n_jobs)
+    elif engine == "sparse":
+        return _comp_corr_rt_sparse(df, thres_rt, thres_corr, thres_pval,
+                                    method, positive, max_memory=max_memory,
+                                    n_jobs=n_jobs)
+    elif engine != "dense":
+        raise ValueError("Engine must be 'tile', 'dense' or 'sparse'.")
+
+    # no features, no pairs. Same empty table as the other engines.
+    if len(df) == 0:
+        idx, val = np.empty(0, dtype=np.int64), np.empty(0)
+        return _corr_tab(df["name"].to_numpy(dtype=object), idx, idx, val,
+                         val, val)
+
     # get data for correlation analysis
     mat = df.drop(['name', 'mz', 'rt'], axis=1)
     mat = mat.T                      # transpose
     mat.columns = df["name"]         # change columns' names
 
     # calculate correlation coefficient and p-values
-    corr, pval = df_corr_pval(mat, method=method)
+    corr, pval = df_corr_pval(mat, method=method, max_memory=max_memory,
+                              dtype=dtype, n_jobs=n_jobs,
+                              thres_pval=thres_pval)
     # corr.isnull().sum()    # check nan
     # pval.isnull().sum()    # check nan
 
@@ -57,25 +116,503 @@ def comp_corr_rt(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
     diff = abs(df_diff(tmp))
     diff[diff > thres_rt] = np.nan
 
-    # combine three conditions
+    # combine three conditions and get the upper triangle of survivors
     ind = corr.notnull() & pval.notnull() & diff.notnull()
+    ia, ib = np.nonzero(np.triu(ind.to_numpy(), 1))
+
+    tab = _corr_tab(df["name"].to_numpy(dtype=object), ia, ib,
+                    corr.to_numpy()[ia, ib], pval.to_numpy()[ia, ib],
+                    diff.to_numpy()[ia, ib])
+
+    return tab
+
+
+# -------------------------------------------------------------------------
+# Correlation analysis of pairs inside retention time window
+def _comp_corr_rt_sparse(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
+                         method="pearson", positive=True,
+                         chunk_size=1000000, max_memory=None, n_jobs=1):
+    """
+    Correlation analysis of pairs inside retention time window.
+
+    Features are sorted by retention time, so the pairs inside the window
+    are a band which is walked chunk by chunk. Only these pairs are
+    correlated and the long-format table is built directly. The result is
+    the same as the 'dense' engine of `comp_corr_rt` up to rounding.
+
+    Parameters
+    ----------
+    df : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    thres_rt, thres_corr, thres_pval, method, positive
+        See `comp_corr_rt`.
+    chunk_size : int
+        Number of candidate pairs processed at a time.
+    max_memory : str or int
+        Memory budget in bytes or with unit. If given, it sets `chunk_size`
+        and the number of pairs summed at a time by `_pair_sums`.
+    n_jobs : int
+        Number of threads. Chunks are processed in parallel.
+
+    Returns
+    -------
+    DataFrame
+        The same as `comp_corr_rt`.
+    """
+
+    mat, name, rt = _corr_mat(df, method)
+
+    step = 100000
+    if max_memory is not None:
+        # half of the budget of each thread for candidate pairs, about 64
+        # bytes each, and half for sums of pairs, about 9 arrays of samples
+        avail = _mem_avail(max_memory, mat.nbytes) // 2 // get_n_jobs(n_jobs)
+        chunk_size = max(avail // 64, 1)
+        step = max(avail // (72 * max(mat.shape[1], 1)), 1)
+
+    def task(ia, ib):
+        # retention time, correlation and p-value filters
+        diff = abs(rt[ib] - rt[ia])
+        idx = diff <= thres_rt
+        ia, ib, diff = ia[idx], ib[idx], diff[idx]
+
+        corr, nobs = _corr_pairs(mat, ia, ib, step=step)
+        if positive:
+            idx = corr > thres_corr
+        else:
+            idx = abs(corr) > thres_corr
+        ia, ib, diff, corr = ia[idx], ib[idx], diff[idx], corr[idx]
+
+        idx, pval = _corr_pval_thres(corr, nobs[idx], thres_pval)
+        return ia[idx], ib[idx], corr[idx], pval, diff[idx]
+
+    res = _imap(task, _rt_pairs(rt, thres_rt, chunk_size), n_jobs)
+    res = list(res)
+    ia, ib, corr, pval, diff = (
+        np.concatenate([x[i] for x in res]) if res else np.empty(0)
+        for i in range(5)
+    )
+
+    return _corr_tab(name, ia, ib, corr, pval, diff)
+
+
+# -------------------------------------------------------------------------
+# Correlation analysis with a fused kernel over tiles of feature pairs
+def _comp_corr_rt_tile(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
+                       method="pearson", positive=True, tile_size=256,
+                       max_memory=None, dtype=None, n_jobs=1):
+    """
+    Correlation analysis with a fused kernel over tiles of feature pairs.
+
+    Features are sorted by retention time and the upper triangle of pairs
+    is visited tile by tile. Tiles entirely outside the retention time
+    window are skipped. A tile is correlated by matrix products, the
+    retention time and correlation thresholds are applied to it at once,
+    p-values are only calculated for the survivors, and surviving edges are
+    appended to preallocated arrays in tile order. Tiles can be processed
+    by a pool of threads since matrix products release the GIL. No square
+    matrix and no merge on names is needed. The result is the same as the
+    'dense' engine of `comp_corr_rt`.
+
+    Parameters
+    ----------
+    df : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    thres_rt, thres_corr, thres_pval, method, positive
+        See `comp_corr_rt`.
+    tile_size : int
+        Number of features of a tile side. It is ignored if `max_memory` is
+        given.
+    max_memory, dtype
+        See `comp_corr_rt`.
+    n_jobs : int
+        Number of threads.
+
+    Returns
+    -------
+    DataFrame
+        The same as `comp_corr_rt`.
+    """
+
+    mat, name, rt = _corr_mat(df, method, dtype or "float64")
+    if max_memory is not None:
+        # about 64 bytes per pair of a tile in each thread
+        tile_size = _block_size(max_memory, 64 * get_n_jobs(n_jobs),
+                                mat.nbytes)
+    order = np.flatnonzero(~np.isnan(rt))
+    order = order[np.argsort(rt[order], kind="stable")]
+    srt = rt[order]
+    n = len(order)
+
+    def tiles():
+        for a in range(0, n, tile_size):
+            b = min(a + tile_size, n)
+            for c in range(a, n, tile_size):
+                # all pairs of this and later tiles are outside the window
+                if srt[c] - srt[b - 1] > thres_rt:
+                    break
+                yield a, b, c, min(c + tile_size, n)
+
+    def task(a, b, c, d):
+        ia, ib, corr, nobs, diff = _corr_tile(mat, rt, order, a, b, c, d,
+                                              thres_rt, thres_corr,
+                                              positive)
+        idx, pval = _corr_pval_thres(corr, nobs, thres_pval)
+        return ia[idx], ib[idx], corr[idx], pval, diff[idx]
+
+    # edge arrays grow by doubling
+    edge = [np.empty(4096, dtype=np.int64), np.empty(4096, dtype=np.int64),
+            np.empty(4096), np.empty(4096), np.empty(4096)]
+    k = 0
+    for res in _imap(task, tiles(), n_jobs):
+        m = len(res[0])
+        if k + m > len(edge[0]):
+            size = max(2 * len(edge[0]), k + m)
+            edge = [np.concatenate([x[:k], np.empty(size - k, x.dtype)])
+                    for x in edge]
+        for x, val in zip(edge, res):
+            x[k:k + m] = val
+        k += m
+
+    return _corr_tab(name, *[x[:k] for x in edge])
+
+
+# -------------------------------------------------------------------------
+# Correlated pairs of a tile inside retention time window
+def _corr_tile(mat, rt, order, a, b, c, d, thres_rt, thres_corr, positive,
+               min_periods=4):
+    """
+    Correlated pairs of a tile inside retention time window.
+
+    Parameters
+    ----------
+    mat : ndarray
+        Features by samples matrix from `_corr_mat`.
+    rt : ndarray
+        Retention time of features.
+    order : ndarray
+        Feature positions in ascending order of retention time.
+    a, b, c, d : int
+        The tile is pairs of `order[a:b]` and `order[c:d]`. Only pairs later
+        in `order` are used, so a diagonal tile is its upper triangle.
+    thres_rt, thres_corr, positive
+        See `comp_corr_rt`.
+    min_periods : int
+        Minimum number of observations required per pair.
+
+    Returns
+    -------
+    ia, ib : ndarray
+        Positions of features of pairs.
+    corr : ndarray
+        Correlation coefficients.
+    nobs : ndarray
+        Number of observations of pairs.
+    diff : ndarray
+        Retention time differences.
+    """
+
+    row, col = order[a:b], order[c:d]
+    corr, nobs = _corr_block(mat[row], mat[col], min_periods)
+
+    diff = abs(rt[col][None, :] - rt[row][:, None])
+    idx = diff <= thres_rt
+    idx &= np.arange(c, d)[None, :] > np.arange(a, b)[:, None]
+    if positive:
+        idx &= corr > thres_corr
+    else:
+        idx &= abs(corr) > thres_corr
+    p, q = np.nonzero(idx)
+
+    return (row[p], col[q], corr[p, q].astype(np.float64),
+            nobs[p, q].astype(np.int64), diff[p, q])
+
+
+# -------------------------------------------------------------------------
+# Get features by samples matrix for correlation analysis
+def _corr_mat(df, method="pearson", dtype="float64"):
+    """
+    Get features by samples matrix for correlation analysis.
+
+    Features are standardised by `_corr_std`.
+
+    Parameters
+    ----------
+    df : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    method : {'pearson', 'spearman'}
+        Correlation method. Intensities of each feature are ranked for
+        'spearman'.
+    dtype : str
+        Type of the matrix.
+
+    Returns
+    -------
+    mat : ndarray
+        Features by samples matrix.
+    name : ndarray
+        Feature names.
+    rt : ndarray
+        Retention time of features.
+    """
+
+    mat = df.drop(['name', 'mz', 'rt'], axis=1).T
+    if method == "spearman":
+        mat = mat.rank()
+    elif method != "pearson":
+        raise ValueError("Method must be either 'pearson' or 'spearman'.")
+    # features by samples for pair-wise access
+    mat = _corr_std(mat.to_numpy(dtype=float).T, dtype)
+    name = df["name"].to_numpy(dtype=object)
+    rt = df["rt"].to_numpy(dtype=float)
+
+    return mat, name, rt
+
+
+# -------------------------------------------------------------------------
+# Standardise features for correlation with matrix products
+def _corr_std(mat, dtype="float64"):
+    """
+    Standardise features for correlation with matrix products.
+
+    Each feature is centred and scaled with its observed values, which
+    keeps sums of products small and stable, in particular for 'float32'.
+    Correlation does not change.
+
+    Parameters
+    ----------
+    mat : ndarray
+        Features by samples matrix.
+    dtype : str
+        Type of the result.
+
+    Returns
+    -------
+    ndarray
+        Standardised matrix. Missing values stay missing.
+    """
+
+    mat = np.where(np.isfinite(mat), mat, np.nan)
+    with warnings.catch_warnings():
+        # all-NaN features
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(mat, axis=1, keepdims=True)
+        sd = np.nanstd(mat, axis=1, keepdims=True)
+    sd[~(sd > 0)] = 1.0
+    mean[np.isnan(mean)] = 0.0
+
+    return np.ascontiguousarray((mat - mean) / sd, dtype=dtype)
+
+
+# -------------------------------------------------------------------------
+# Pair-wise complete correlation of two blocks of features
+def _corr_block(x, y, min_periods=4):
+    """
+    Pair-wise complete Pearson correlation of two blocks of features.
+
+    Each pair uses the samples observed in both features. Sums over these
+    samples are matrix products of observation masks and zero-filled
+    values, so the block is computed by a few BLAS calls in the type of
+    `x` and `y`.
+
+    Parameters
+    ----------
+    x : ndarray
+        Features by samples matrix of the first block.
+    y : ndarray
+        Features by samples matrix of the second block.
+    min_periods : int
+        Minimum number of observations required per pair.
+
+    Returns
+    -------
+    corr : ndarray
+        Correlation coefficients of `x` by `y`. NaN if not enough
+        observations or no variance.
+    nobs : ndarray
+        Number of observations of each pair.
+    """
+
+    mx = np.isfinite(x)
+    my = np.isfinite(y)
+    x = np.where(mx, x, 0)
+    y = np.where(my, y, 0)
+    mx = mx.astype(x.dtype)
+    my = my.astype(y.dtype)
+
+    nobs = mx @ my.T
+    corr = _corr_sums(nobs, x @ my.T, mx @ y.T, (x * x) @ my.T,
+                      mx @ (y * y).T, x @ y.T, min_periods)
+
+    return corr, nobs
+
+
+# -------------------------------------------------------------------------
+# Correlation from sums over observed samples
+def _corr_sums(nobs, sx, sy, sxx, syy, sxy, min_periods=4):
+    """
+    Correlation from sums over observed samples.
+
+    Parameters
+    ----------
+    nobs : ndarray
+        Number of observations of pairs.
+    sx, sy : ndarray
+        Sums of the two features.
+    sxx, syy : ndarray
+        Sums of squares of the two features.
+    sxy : ndarray
+        Sums of cross-products.
+    min_periods : int
+        Minimum number of observations required per pair.
+
+    Returns
+    -------
+    ndarray
+        Correlation coefficients. NaN if not enough observations or no
+        variance.
+    """
 
-    # update
-    corr = corr[ind]
-    pval = pval[ind]
-    diff = diff[ind]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = sxy - sx * sy / nobs
+        var = (sxx - sx * sx / nobs) * (syy - sy * sy / nobs)
+        corr = np.clip(cov / np.sqrt(var), -1.0, 1.0)
+    corr[(nobs < min_periods) | ~(var > 0)] = np.nan
 
-    # convert to long format
-    corr = df_short2long(corr).rename(columns={'var': 'r_value'})
-    pval = df_short2long(pval).rename(columns={'var': 'p_value'})
-    diff = df_short2long(diff).rename(columns={'var': 'rt_diff'})
+    return corr
+
+
+# -------------------------------------------------------------------------
+# Get block size from memory budget
+def _block_size(max_memory, pair_bytes, fixed=0):
+    """
+    Get block size from memory budget.
+
+    Parameters
+    ----------
+    max_memory : str or int
+        Memory budget. See `lamp.utils.parse_size`.
+    pair_bytes : int
+        Working memory per pair of a block.
+    fixed : int
+        Memory used anyway, e.g. by the data matrix.
+
+    Returns
+    -------
+    int
+        Number of features of a block side, at least 16.
+    """
+
+    avail = _mem_avail(max_memory, fixed)
+
+    return max(int(np.sqrt(avail / pair_bytes)), 16)
+
+
+# -------------------------------------------------------------------------
+# Get available memory of a budget
+def _mem_avail(max_memory, fixed=0):
+    """
+    Get available memory of a budget.
+
+    Parameters
+    ----------
+    max_memory : str or int
+        Memory budget. See `lamp.utils.parse_size`.
+    fixed : int
+        Memory used anyway, e.g. by the data matrix.
+
+    Returns
+    -------
+    int
+        Bytes of the budget left for working space.
+    """
+
+    avail = parse_size(max_memory) - fixed
+    if avail <= 0:
+        raise ValueError("Memory budget is too small for the data.")
+
+    return int(avail)
+
+
+# -------------------------------------------------------------------------
+# Map a function over tasks in threads in order
+def _imap(func, tasks, n_jobs=1):
+    """
+    Map a function over tasks in a pool of threads in order.
+
+    At most two tasks per thread are in flight, so tasks from a generator
+    are not all held in memory.
+
+    Parameters
+    ----------
+    func : callable
+        Function called as `func(*task)`.
+    tasks : iterable
+        Tuples of arguments.
+    n_jobs : int
+        Number of threads. -1 means using all processors.
+
+    Yields
+    ------
+    object
+        Results of `func` in the order of `tasks`.
+    """
+
+    n_jobs = get_n_jobs(n_jobs)
+    if n_jobs <= 1:
+        for x in tasks:
+            yield func(*x)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+        queue = deque()
+        for x in tasks:
+            queue.append(ex.submit(func, *x))
+            if len(queue) >= 2 * n_jobs:
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+
+
+# -------------------------------------------------------------------------
+# Build long-format correlation table from edges
+def _corr_tab(name, ia, ib, corr, pval, diff):
+    """
+    Build long-format correlation table from edges.
+
+    A pair is reported once, oriented by `_pair_orient`, and pairs are in
+    row-major order of the feature matrix, the same as `df_short2long`.
+
+    Parameters
+    ----------
+    name : ndarray
+        Feature names.
+    ia, ib : ndarray
+        Positions of features of edges.
+    corr, pval, diff : ndarray
+        Correlation coefficients, p-values and retention time differences
+        of edges. Coefficients are reported in double precision whatever
+        the type of calculation.
+
+    Returns
+    -------
+    DataFrame
+        A table with columns "name_a", "name_b", "r_value", "p_value" and
+        "rt_diff".
+    """
+
+    ia, ib = _pair_orient(name, ia, ib)
+    idx = np.lexsort((ib, ia))
 
-    # merge
     tab = (
-        corr
-        .merge(pval, on=['com1', 'com2'], how='inner')
-        .merge(diff, on=['com1', 'com2'], how='inner')
-        .rename(columns={"com1": "name_a", "com2": "name_b"})
+        pd.DataFrame({
+            "name_a": name[ia[idx]], "name_b": name[ib[idx]],
+            "r_value": corr[idx].astype(np.float64), "p_value": pval[idx],
+            "rt_diff": diff[idx],
+        })
         .round({'r_value': 2})
         .round({'rt_diff': 2})
     )
@@ -83,9 +620,432 @@ def comp_corr_rt(df, thres_rt=5.0, thres_corr=0.7, thres_pval=0.05,
     return tab
 
 
+# -------------------------------------------------------------------------
+# Orient pairs of features by names
+def _pair_orient(name, ia, ib):
+    """
+    Orient pairs of features by names.
+
+    A pair is oriented so that the first name is smaller. Pairs with equal
+    names, or all pairs if names cannot be compared, are oriented by
+    positions instead.
+
+    Parameters
+    ----------
+    name : ndarray
+        Feature names.
+    ia, ib : ndarray
+        Positions of features of pairs.
+
+    Returns
+    -------
+    tuple
+        Oriented positions `ia` and `ib`.
+    """
+
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+    swap = ib < ia
+    try:
+        swap = np.where(name[ia] == name[ib], swap,
+                        np.asarray(name[ib] < name[ia], dtype=bool))
+    except TypeError:
+        pass
+
+    return np.where(swap, ib, ia), np.where(swap, ia, ib)
+
+
+# -------------------------------------------------------------------------
+# Get feature pairs inside retention time window chunk by chunk
+def _rt_pairs(rt, thres_rt, chunk_size=1000000):
+    """
+    Get feature pairs inside retention time window chunk by chunk.
+
+    Parameters
+    ----------
+    rt : ndarray
+        Retention time of features.
+    thres_rt : float
+        Threshold for retention time.
+    chunk_size : int
+        Approximate number of pairs of a chunk.
+
+    Yields
+    ------
+    tuple
+        Two arrays of feature positions. Each pair is yielded once. It is a
+        superset of pairs with difference not above `thres_rt`.
+    """
+
+    order = np.flatnonzero(~np.isnan(rt))
+    order = order[np.argsort(rt[order], kind="stable")]
+    srt = rt[order]
+
+    # window with a little slack for rounding. Exact check is up to caller.
+    upper = srt + thres_rt + 1e-9 * (abs(srt) + abs(thres_rt))
+    stop = np.searchsorted(srt, upper, side="right")
+    cnt = np.maximum(stop - np.arange(len(srt)) - 1, 0)
+    end = np.cumsum(cnt)
+
+    # rows of the band in chunks
+    lo = 0
+    while lo < len(srt):
+        start = end[lo] - cnt[lo]
+        hi = max(np.searchsorted(end, start + chunk_size, side="right"),
+                 lo + 1)
+        num = cnt[lo:hi]
+        row = np.arange(lo, hi)
+        lo = hi
+        if num.sum() == 0:
+            continue
+        # position in row of each pair
+        off = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+        ia = np.repeat(row, num)
+        ib = ia + 1 + off
+        yield order[ia], order[ib]
+
+
+# -------------------------------------------------------------------------
+# Pair-wise correlation of features with missing values
+def _corr_pairs(mat, ia, ib, min_periods=4, step=100000):
+    """
+    Pair-wise Pearson correlation of features with missing values.
+
+    Each pair uses the samples observed in both features. Correlation is
+    calculated from sums over these samples as `_corr_block` does. The
+    kernel is compiled with `numba` if it is installed.
+
+    Parameters
+    ----------
+    mat : ndarray
+        Features by samples matrix from `_corr_mat`.
+    ia, ib : ndarray
+        Positions of features of pairs.
+    min_periods : int
+        Minimum number of observations required per pair.
+    step : int
+        Number of pairs summed at a time without `numba`. See `_pair_sums`.
+
+    Returns
+    -------
+    corr : ndarray
+        Correlation coefficients. NaN if not enough observations or no
+        variance.
+    nobs : ndarray
+        Number of observations of pairs.
+    """
+
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+
+    if njit is not None:
+        return _corr_pairs_kernel(mat, ia, ib, min_periods)
+
+    sums = _pair_sums(mat, ia, ib, step)
+
+    return _corr_sums(*sums, min_periods), sums[0]
+
+
+# -------------------------------------------------------------------------
+# Sums of pairs of features over observed samples
+def _pair_sums(mat, ia, ib, step=100000):
+    """
+    Sums of pairs of features over samples observed in both.
+
+    Parameters
+    ----------
+    mat : ndarray
+        Features by samples matrix.
+    ia, ib : ndarray
+        Positions of features of pairs.
+    step : int
+        Number of pairs processed at a time.
+
+    Returns
+    -------
+    tuple
+        Number of observations, sums of the two features, sums of their
+        squares and sums of cross-products of pairs.
+    """
+
+    ia = np.asarray(ia, dtype=np.int64)
+    ib = np.asarray(ib, dtype=np.int64)
+    nobs = np.empty(len(ia), dtype=np.int64)
+    sums = [np.empty(len(ia)) for _ in range(5)]
+    for k in range(0, len(ia), step):
+        sub = slice(k, k + step)
+        x, y = mat[ia[sub]], mat[ib[sub]]
+        m = np.isfinite(x) & np.isfinite(y)
+        x = np.where(m, x, 0.0)
+        y = np.where(m, y, 0.0)
+        nobs[sub] = m.sum(axis=1)
+        for res, val in zip(sums, (x, y, x * x, y * y, x * y)):
+            res[sub] = val.sum(axis=1)
+
+    return (nobs, *sums)
+
+
+# -------------------------------------------------------------------------
+# Pair-wise correlation kernel of `_corr_pairs`
+def _corr_pairs_kernel(mat, ia, ib, min_periods):
+    """Internal function for `_corr_pairs` with `numba`."""
+
+    corr = np.empty(len(ia))
+    nobs = np.empty(len(ia), dtype=np.int64)
+    for k in range(len(ia)):
+        x = mat[ia[k]]
+        y = mat[ib[k]]
+        n = 0
+        sx = sy = sxx = syy = sxy = 0.0
+        for i in range(len(x)):
+            if np.isfinite(x[i]) and np.isfinite(y[i]):
+                n += 1
+                sx += x[i]
+                sy += y[i]
+                sxx += x[i] * x[i]
+                syy += y[i] * y[i]
+                sxy += x[i] * y[i]
+        nobs[k] = n
+        corr[k] = np.nan
+        if n >= min_periods:
+            var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+            if var > 0:
+                r = (sxy - sx * sy / n) / np.sqrt(var)
+                corr[k] = min(max(r, -1.0), 1.0)
+
+    return corr, nobs
+
+
+if njit is not None:
+    _corr_pairs_kernel = njit(cache=True, nogil=True)(_corr_pairs_kernel)
+
+
+# Sufficient statistics of a correlation state
+_STATE_SUMS = ("nobs", "sx", "sy", "sxx", "syy", "sxy")
+
+
+# -------------------------------------------------------------------------
+# Build incremental correlation state of pairs inside retention time window
+def corr_state(df, thres_rt=5.0, chunk_size=1000000):
+    """
+    Build incremental correlation state of pairs inside retention time
+    window.
+
+    The state keeps sufficient statistics of Pearson correlation of each
+    pair inside the window: number of observations, sums, sums of squares
+    and cross-products over the samples observed in both features. Each
+    feature is shifted by its mean in `df` to keep sums small. New samples
+    are folded in by `corr_state_update` and the correlation table is
+    produced by `corr_state_table`, both in time proportional to the
+    number of pairs and the new samples only.
+
+    Parameters
+    ----------
+    df : DataFrame
+        A pandas data frame of peak table. It must have "name", "mz" and
+        "rt" columns.
+    thres_rt : float
+        Threshold for retention time. Pairs inside it are kept.
+    chunk_size : int
+        Number of candidate pairs processed at a time.
+
+    Returns
+    -------
+    dict
+        Correlation state. See `save_corr_state` to keep it on disk.
+
+    Examples
+    --------
+    >>> state = corr_state(df, thres_rt=1.0)
+    >>> state = corr_state_update(state, df_new)
+    >>> corr = corr_state_table(state, thres_corr=0.5)
+    >>> corr_df = corr_grp_size(corr)
+    """
+
+    mat, samples = _state_mat(df)
+    name = df["name"].to_numpy(dtype=object)
+    rt = df["rt"].to_numpy(dtype=float)
+    with warnings.catch_warnings():
+        # all-NaN features
+        warnings.simplefilter("ignore", RuntimeWarning)
+        shift = np.nanmean(mat, axis=1)
+    shift[np.isnan(shift)] = 0.0
+
+    ia, ib = [], []
+    for a, b in _rt_pairs(rt, thres_rt, chunk_size):
+        idx = abs(rt[b] - rt[a]) <= thres_rt
+        ia.append(a[idx])
+        ib.append(b[idx])
+    ia = np.concatenate(ia) if ia else np.empty(0, dtype=np.int64)
+    ib = np.concatenate(ib) if ib else np.empty(0, dtype=np.int64)
+
+    state = {
+        "name": name, "rt": rt, "shift": shift,
+        "samples": np.asarray(samples, dtype=str),
+        "thres_rt": np.float64(thres_rt), "ia": ia, "ib": ib,
+    }
+    sums = _pair_sums(mat - shift[:, None], ia, ib)
+    state.update(zip(_STATE_SUMS, sums))
+
+    return state
+
+
+# -------------------------------------------------------------------------
+# Fold new samples into correlation state
+def corr_state_update(state, df):
+    """
+    Fold new samples into correlation state.
+
+    Parameters
+    ----------
+    state : dict
+        Correlation state from `corr_state`.
+    df : DataFrame
+        A pandas data frame of peak table of new samples. It must have
+        "name", "mz" and "rt" columns and the same features as `state`.
+
+    Returns
+    -------
+    dict
+        Updated correlation state. `state` is not changed.
+    """
+
+    mat, samples = _state_mat(df)
+    dup = np.intersect1d(state["samples"], np.asarray(samples, dtype=str))
+    if len(dup):
+        raise ValueError("Samples already in correlation state: "
+                         "{}".format(", ".join(dup)))
+
+    # match features by names
+    name = df["name"].to_numpy(dtype=object)
+    if not np.array_equal(name, state["name"]):
+        pos = pd.Index(name)
+        if not pos.is_unique or not pos.isin(state["name"]).all() or \
+                len(pos) != len(state["name"]):
+            raise ValueError("Features must be the same as in correlation "
+                             "state.")
+        mat = mat[pos.get_indexer(state["name"])]
+
+    state = dict(state)
+    state["samples"] = np.concatenate([state["samples"],
+                                       np.asarray(samples, dtype=str)])
+    sums = _pair_sums(mat - state["shift"][:, None], state["ia"],
+                      state["ib"])
+    for key, val in zip(_STATE_SUMS, sums):
+        state[key] = state[key] + val
+
+    return state
+
+
+# -------------------------------------------------------------------------
+# Get correlation table from correlation state
+def corr_state_table(state, thres_rt=None, thres_corr=0.7, thres_pval=0.05,
+                     positive=True, min_periods=4):
+    """
+    Get correlation table from correlation state.
+
+    Parameters
+    ----------
+    state : dict
+        Correlation state from `corr_state` or `corr_state_update`.
+    thres_rt : float
+        Threshold for retention time. It must not be larger than the one
+        of `state`. If None, use the one of `state`.
+    thres_corr, thres_pval, positive
+        See `comp_corr_rt`.
+    min_periods : int
+        Minimum number of observations required per pair.
+
+    Returns
+    -------
+    DataFrame
+        The same as `comp_corr_rt` with 'pearson' on all samples of
+        `state`, up to rounding.
+    """
+
+    if thres_rt is None:
+        thres_rt = state["thres_rt"]
+    elif thres_rt > state["thres_rt"]:
+        raise ValueError("Threshold for retention time is larger than the "
+                         "one of correlation state.")
+
+    name, rt = state["name"], state["rt"]
+    ia, ib = state["ia"], state["ib"]
+    diff = abs(rt[ib] - rt[ia])
+    corr = _corr_sums(*[state[x] for x in _STATE_SUMS], min_periods)
+
+    idx = diff <= thres_rt
+    if positive:
+        idx &= corr > thres_corr
+    else:
+        idx &= abs(corr) > thres_corr
+    idx = np.flatnonzero(idx)
+    keep, pval = _corr_pval_thres(corr[idx], state["nobs"][idx],
+                                  thres_pval)
+    idx = idx[keep]
+
+    return _corr_tab(name, ia[idx], ib[idx], corr[idx], pval, diff[idx])
+
+
+# -------------------------------------------------------------------------
+# Save correlation state
+def save_corr_state(state, fn):
+    """
+    Save correlation state.
+
+    Parameters
+    ----------
+    state : dict
+        Correlation state.
+    fn : str
+        File name. `numpy` adds extension '.npz' if it is not given.
+    """
+
+    state = dict(state, name=np.asarray(state["name"], dtype=str))
+    np.savez(fn, **state)
+
+
+# -------------------------------------------------------------------------
+# Load correlation state
+def load_corr_state(fn):
+    """
+    Load correlation state.
+
+    Parameters
+    ----------
+    fn : str
+        File name of a state saved by `save_corr_state`.
+
+    Returns
+    -------
+    dict
+        Correlation state.
+    """
+
+    with np.load(fn, allow_pickle=False) as f:
+        state = {x: f[x] for x in f.files}
+    state["name"] = state["name"].astype(object)
+    state["thres_rt"] = np.float64(state["thres_rt"])
+
+    return state
+
+
+# -------------------------------------------------------------------------
+# Get features by samples matrix of raw intensities
+def _state_mat(df):
+    """Internal function for correlation state."""
+
+    mat = df.drop(['name', 'mz', 'rt'], axis=1)
+    samples = [str(x) for x in mat.columns]
+    mat = mat.to_numpy(dtype=float)
+    mat[~np.isfinite(mat)] = np.nan
+
+    return mat, samples
+
+
 # -------------------------------------------------------------------------
 # wl-20-05-2024, Mon: get correlation group and size
-def corr_grp_size(corr):
+def corr_grp_size(corr, grouping="neighbors"):
     """
     Get correlation group and size.
 
@@ -95,19 +1055,38 @@ def corr_grp_size(corr):
         A long-format correlation table. The front two columns
         names must be 'name_a' and 'name_b'. Other columns could be
         correlation coefficient, p-values and any other values.
+    grouping : {'neighbors', 'components', 'cliques'}
+        Grouping of correlated features:
+        * neighbors : the group of a feature is its correlated features.
+          Groups overlap.
+        * components : connected components of the correlation graph
+        * cliques : greedy clique partition of the correlation graph.
+          Features of a group are all correlated with each other, but a
+          group is not necessarily a maximal clique of the graph. See
+          `_corr_cliques`.
+        The last two partition features, so each group has an integer id.
 
     Returns
     -------
     DataFrame
         A data frame with three columns, "name", "cor_grp_size" and
-        "cor_grp".
+        "cor_grp". For 'components' and 'cliques', there is also column
+        "cor_grp_id" and "cor_grp" has all members of the group including
+        the feature itself.
     """
+    if grouping in ("components", "cliques"):
+        return _corr_grp_part(corr, grouping)
+    elif grouping != "neighbors":
+        raise ValueError("Grouping must be 'neighbors', 'components' or "
+                         "'cliques'.")
+
     # get correlated groups/clusters
     cor_nam = corr['name_a'].to_list()
     cor_nam.extend(corr['name_b'].to_list())
     cor_nam = list(set(cor_nam))
-    cor_grp = [corr_grp(x, corr) for x in cor_nam]
-    # cor_grp_dict = {x: mt.corr_grp(x, corr) for x in cor_nam}
+    # cor_grp = [corr_grp(x, corr) for x in cor_nam]
+    cor_grp = _corr_nbr(corr)
+    cor_grp = [cor_grp[x] for x in cor_nam]
     cor_len = [len(x) for x in cor_grp]
     cor_str = ['::'.join(x) for x in cor_grp]
     # merge into a data frame
@@ -118,6 +1097,148 @@ def corr_grp_size(corr):
     return cor_df
 
 
+# -------------------------------------------------------------------------
+# Partition correlated features into groups
+def _corr_grp_part(corr, grouping="components"):
+    """
+    Partition correlated features into groups.
+
+    Parameters
+    ----------
+    corr : DataFrame
+        A long-format correlation table with 'name_a' and 'name_b'.
+    grouping : {'components', 'cliques'}
+        See `corr_grp_size`.
+
+    Returns
+    -------
+    DataFrame
+        A data frame with columns "name", "cor_grp_id", "cor_grp_size" and
+        "cor_grp". Group ids are in descending order of size and features
+        are in order of appearance in `corr`.
+    """
+
+    code, name = pd.factorize(np.concatenate([
+        corr['name_a'].to_numpy(dtype=object),
+        corr['name_b'].to_numpy(dtype=object),
+    ]))
+    n = len(name)
+    # symmetric adjacency without self loops
+    row, col = code[:len(corr)], code[len(corr):]
+    keep = row != col
+    row, col = np.r_[row[keep], col[keep]], np.r_[col[keep], row[keep]]
+    adj = coo_matrix((np.ones(len(row), dtype=np.int8), (row, col)),
+                     shape=(n, n)).tocsr()
+
+    if grouping == "components":
+        label = connected_components(adj, directed=False)[1]
+    else:
+        label = _corr_cliques(adj.indptr, adj.indices)
+
+    # compact ids by descending size, then first appearance
+    size = np.bincount(label, minlength=label.max() + 1 if n else 0)
+    first = np.full(len(size), n)
+    np.minimum.at(first, label, np.arange(n))
+    rank = np.empty(len(size), dtype=np.int64)
+    rank[np.lexsort((first, -size))] = np.arange(len(size))
+    gid = rank[label]
+
+    order = np.lexsort((np.arange(n), gid))
+    gid = gid[order]
+    size = np.bincount(gid, minlength=len(size))
+    end = np.cumsum(size)
+    member = name[order].tolist()
+    grp = ['::'.join(member[a:z]) for a, z in zip(end - size, end)]
+
+    cor_df = pd.DataFrame({
+        'name': name[order],
+        'cor_grp_id': gid,
+        'cor_grp_size': size[gid],
+        'cor_grp': [grp[x] for x in gid],
+    })
+
+    return cor_df
+
+
+# -------------------------------------------------------------------------
+# Greedy clique partition of a graph
+def _corr_cliques(indptr, indices):
+    """
+    Greedy clique partition of a graph.
+
+    Vertices are visited in descending order of degree. An unassigned
+    vertex starts a clique, and its unassigned neighbours are added in the
+    same order if they are adjacent to all members so far. Every vertex
+    belongs to exactly one clique. A clique only grows among vertices not
+    assigned yet, so later cliques are not necessarily maximal in the
+    graph.
+
+    Parameters
+    ----------
+    indptr, indices : ndarray
+        Symmetric adjacency in CSR format without self loops.
+
+    Returns
+    -------
+    ndarray
+        Clique label of each vertex.
+    """
+
+    n = len(indptr) - 1
+    deg = np.diff(indptr)
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.argsort(-deg, kind="stable")] = np.arange(n)
+    nbr = [set(indices[indptr[i]:indptr[i + 1]].tolist()) for i in range(n)]
+
+    label = np.full(n, -1, dtype=np.int64)
+    k = 0
+    for v in np.argsort(rank).tolist():
+        if label[v] >= 0:
+            continue
+        label[v] = k
+        clique = []
+        for u in sorted(nbr[v], key=rank.__getitem__):
+            if label[u] < 0 and all(u in nbr[w] for w in clique):
+                label[u] = k
+                clique.append(u)
+        k += 1
+
+    return label
+
+
+# -------------------------------------------------------------------------
+# Get correlated groups of all names in one pass
+def _corr_nbr(corr):
+    """
+    Get correlated groups of all names in one pass.
+
+    Edges are made directed in both ways and sorted stably by their source
+    name, so each group is a contiguous slice. Members are in the same
+    order as `corr_grp`.
+
+    Parameters
+    ----------
+    corr : DataFrame
+        A long-format correlation table with 'name_a' and 'name_b'.
+
+    Returns
+    -------
+    dict
+        Names and lists of their correlated names.
+    """
+
+    src = np.concatenate([corr['name_a'].to_numpy(dtype=object),
+                          corr['name_b'].to_numpy(dtype=object)])
+    dst = np.concatenate([corr['name_b'].to_numpy(dtype=object),
+                          corr['name_a'].to_numpy(dtype=object)])
+    code, uniq = pd.factorize(src)
+    order = np.argsort(code, kind="stable")
+    dst = dst[order].tolist()
+    end = np.cumsum(np.bincount(code, minlength=len(uniq))).tolist()
+
+    return {x: dst[a:z] for x, a, z in zip(uniq, [0] + end[:-1], end)}
+
+
 # -----------------------------------------------------------------------
 # wl-01-05-2024, Wed: get correlation group
 def corr_grp(x, corr):
@@ -160,11 +1281,15 @@ def corr_grp(x, corr):
 # wl-06-12-2023, Wed: 'spearman' is extremely slow. Use rank's 'pearson' as
 #  the alternative (ultimately doing the same calculation). For details, see
 #  https://bit.ly/4a9y1X2
-def df_corr_pval(df, method="pearson", min_periods=4):
+def df_corr_pval(df, method="pearson", min_periods=4, max_memory=None,
+                 dtype=None, nobs=False, n_jobs=1, thres_pval=None):
     """
     Calculate matrix's correlation and p-values.
 
-    This function calls pandas.DataFrame.corr().
+    Each pair of columns is correlated over the rows observed in both, as
+    pandas.DataFrame.corr() does, but block by block with masked matrix
+    products (see `_corr_block`). P-values are based on the number of these
+    rows of each pair.
 
     Parameters
     ----------
@@ -177,6 +1302,19 @@ def df_corr_pval(df, method="pearson", min_periods=4):
     min_periods : int
         Minimum number of observations required per pair of columns
         to have a valid result.
+    max_memory : str or int
+        Memory budget of working space besides the result matrices, in
+        bytes or with unit, e.g. '4G'. Default is unlimited.
+    dtype : {None, 'float32', 'float64'}
+        Type of blocked calculation and correlation matrix. Default is
+        'float64'. P-values are always in double precision.
+    nobs : bool
+        Return the number of observations of each pair as well.
+    n_jobs : int
+        Number of threads for blocks. -1 means using all processors.
+    thres_pval : float
+        Threshold of p-values. If given, p-values are only calculated for
+        pairs below it and others are NaN. See `_corr_pval_thres`.
 
     Returns
     -------
@@ -184,6 +1322,8 @@ def df_corr_pval(df, method="pearson", min_periods=4):
         Correlation matrix
     pval : DataFrame
         p-value matrix
+    nobs : DataFrame
+        Matrix of number of observations. Only if `nobs` is True.
 
     Examples
     --------
@@ -193,50 +1333,156 @@ def df_corr_pval(df, method="pearson", min_periods=4):
     >>> df.columns = ['col{}'.format(x) for x in range(m)]
     >>> co, pv = df_corr_pval(df)
     """
-    def corr_pval_two_side(cc, nData):
-        # We will divide by 0 if correlation is exactly 1, but that is no
-        # problem. We would simply set the test statistic to be infinity if
-        # it evaluates to NAN
-        with np.errstate(divide='ignore'):
-            t = -np.abs(cc) * np.sqrt((nData - 2) / (1 - cc**2))
-            t[t == np.nan] = np.inf
-            # multiply by two to get two-sided p-value
-            return scipy.stats.t.cdf(t, nData - 2) * 2
-
-    # get correlation. Very fast for 'pearson'.
-    if False:
-        corr = df.corr(method=method, min_periods=min_periods)
-    else:
-        if method == "pearson":
-            corr = df.corr(method="pearson", min_periods=min_periods)
-        elif method == "spearman":  # 06-12-2023, Wed: fast than 'spearman'
-            corr = df.rank().corr(method="pearson", min_periods=min_periods)
-        else:
-            raise ValueError("Method must be either 'pearson' or 'spearman'.")
-
-    flag = False
-    if flag:    # call df.corr again
-        if method == "pearson":
-            meth_corr = scipy.stats.pearsonr
-        elif method == "spearman":
-            meth_corr = scipy.stats.spearmanr
+
+    if method == "spearman":  # 06-12-2023, Wed: fast than 'spearman'
+        df = df.rank()
+    elif method != "pearson":
+        raise ValueError("Method must be either 'pearson' or 'spearman'.")
+
+    dtype = np.dtype(dtype or "float64")
+    mat = _corr_std(df.to_numpy(dtype=float).T, dtype)
+    m = mat.shape[0]
+    corr = np.empty((m, m), dtype=dtype)
+    pval = np.empty((m, m), dtype=np.float64)
+    cnt = np.empty((m, m), dtype=np.int64) if nobs else None
+
+    # about 12 matrices of a block pair in working space of each thread
+    size = 2048
+    if max_memory is not None:
+        fixed = mat.nbytes + corr.nbytes + pval.nbytes
+        if nobs:
+            fixed += cnt.nbytes
+        size = _block_size(max_memory, 12 * dtype.itemsize *
+                           get_n_jobs(n_jobs), fixed)
+
+    def task(a, c):
+        # blocks write to disjoint parts of the results
+        x = mat[a:a + size]
+        y = mat[c:c + size]
+        r, n = _corr_block(x, y, min_periods)
+        if a == c:
+            # a valid feature is perfectly correlated with itself
+            idx = np.arange(len(r))
+            r[idx, idx] = np.where(np.isnan(r[idx, idx]), np.nan, 1.0)
+        if thres_pval is None:
+            p = _corr_pval_two_side(r.astype(np.float64), n)
         else:
-            raise ValueError("Method must be either 'pearson' or 'spearman'.")
-        # get p-values
-        pval = df.corr(method=lambda x, y: meth_corr(x, y)[1],
-                       min_periods=min_periods) - np.eye(len(df.columns))
-    else:       # use local function
-        # sample size is row of df, not col of df
-        pval = corr_pval_two_side(corr, df.shape[0])
-        # pval = corr_to_pval(corr, df.shape[0])
-        pval = pd.DataFrame(pval)
-        # set dimension names as 'corr'
-        pval.index = corr.index
-        pval.columns = corr.columns
+            p = np.full(r.shape, np.nan)
+            idx, pv = _corr_pval_thres(r.astype(np.float64), n, thres_pval)
+            p[idx] = pv
+        corr[a:a + size, c:c + size] = r
+        corr[c:c + size, a:a + size] = r.T
+        pval[a:a + size, c:c + size] = p
+        pval[c:c + size, a:a + size] = p.T
+        if nobs:
+            cnt[a:a + size, c:c + size] = n
+            cnt[c:c + size, a:a + size] = n.T
+
+    blocks = [(a, c) for a in range(0, m, size) for c in range(a, m, size)]
+    for _ in _imap(task, blocks, n_jobs):
+        pass
+
+    corr = pd.DataFrame(corr, index=df.columns, columns=df.columns)
+    pval = pd.DataFrame(pval, index=df.columns, columns=df.columns)
+    if nobs:
+        cnt = pd.DataFrame(cnt, index=df.columns, columns=df.columns)
+        return corr, pval, cnt
 
     return corr, pval
 
 
+# -------------------------------------------------------------------------
+# Two-sided p-values of correlation coefficients
+def _corr_pval_two_side(cc, nData):
+    """
+    Internal function for two-sided p-values of correlation.
+
+    `nData` is the sample size, either a number or an array of the size of
+    each coefficient.
+    """
+
+    # We will divide by 0 if correlation is exactly 1, but that is no
+    # problem. We would simply set the test statistic to be infinity if
+    # it evaluates to NAN
+    with np.errstate(divide='ignore'):
+        t = -np.abs(cc) * np.sqrt((nData - 2) / (1 - cc**2))
+        t[t == np.nan] = np.inf
+        # multiply by two to get two-sided p-value
+        return scipy.stats.t.cdf(t, nData - 2) * 2
+
+
+# -------------------------------------------------------------------------
+# P-values of correlation coefficients below a threshold
+def _corr_pval_thres(cc, nobs, thres_pval):
+    """
+    P-values of correlation coefficients below a threshold.
+
+    For a sample size, a two-sided p-value is below the threshold if and
+    only if the absolute coefficient is above a critical value. Pairs are
+    filtered on the critical values of their sample sizes first and exact
+    p-values are only calculated for the survivors.
+
+    Parameters
+    ----------
+    cc : ndarray
+        Correlation coefficients.
+    nobs : ndarray
+        Sample size of each coefficient.
+    thres_pval : float
+        Threshold of p-values.
+
+    Returns
+    -------
+    idx : ndarray
+        Boolean mask of coefficients with p-values below `thres_pval`.
+    pval : ndarray
+        P-values of `cc[idx]`.
+    """
+
+    nobs = np.asarray(nobs, dtype=np.int64)
+    idx = np.isfinite(cc)
+    if 0 < thres_pval < 1 and nobs.size:
+        # a little slack for rounding. Exact check is below.
+        crit = _corr_crit(float(thres_pval), int(nobs.max()))
+        idx &= np.abs(cc) > crit[nobs] * (1 - 1e-9)
+    pval = _corr_pval_two_side(cc[idx], nobs[idx])
+    keep = pval < thres_pval
+    idx[idx] = keep
+
+    return idx, pval[keep]
+
+
+# -------------------------------------------------------------------------
+# Critical correlation coefficients of a p-value threshold
+@functools.lru_cache(maxsize=64)
+def _corr_crit(thres_pval, n_max):
+    """
+    Critical correlation coefficients of a two-sided p-value threshold.
+
+    Parameters
+    ----------
+    thres_pval : float
+        Threshold of p-values between 0 and 1.
+    n_max : int
+        The largest sample size.
+
+    Returns
+    -------
+    ndarray
+        Critical coefficient for sample sizes from 0 to `n_max`. Infinite
+        if the sample size is too small to have a p-value.
+    """
+
+    n = np.arange(n_max + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = scipy.stats.t.isf(thres_pval / 2, n - 2)
+        crit = t / np.sqrt(n - 2 + t**2)
+    crit[n <= 2] = np.inf
+    crit.flags.writeable = False
+
+    return crit
+
+
 # -------------------------------------------------------------------------
 # wl-04-12-2023, Mon: Convert short to long format and remove NAs
 # Note that this function will remove NAs.
@@ -247,6 +1493,10 @@ def df_short2long(df):
     This function convert so-called short format matrix to long format
     matrix. Also the missing values will be removed.
 
+    Each pair of the upper triangle is reported once, oriented so that
+    'com1' < 'com2' if names can be compared, and pairs are in row-major
+    order. Pairs of duplicate names are kept in positional order.
+
     Parameters
     ----------
     df : DataFRame
@@ -255,32 +1505,23 @@ def df_short2long(df):
     Returns
     -------
     DataFrame
-        A data frame.
+        A data frame with columns 'com1', 'com2' and 'var'.
     """
 
-    # reset columns and index names
-    df = df.rename_axis(None).rename_axis(None, axis=1)
-    # df.index.name = None
+    arr = df.to_numpy()
+    name = np.asarray(df.index, dtype=object)
 
-    # reshape data frame
-    long_df = df.stack().reset_index()
-    long_df.columns = ['com1', 'com2', 'var']
+    # non-missing entries of the upper triangle, without diagonal
+    ia, ib = np.nonzero(np.triu(pd.notna(arr), 1))
+    ia, ib = _pair_orient(name, ia, ib)
+    idx = np.lexsort((ib, ia))
+    ia, ib = ia[idx], ib[idx]
 
-    # Exclude the diagonal and duplicate entries
-    if True:
-        long_df = long_df[long_df['com1'] < long_df['com2']]
-    else:
-        # create a mask to identify rows with duplicate features
-        # See https://bit.ly/3Ooei9W for details.
-        idx = (
-            (long_df[['com1', 'com2']].apply(frozenset, axis=1).duplicated()) | \
-            (long_df['com1'] == long_df['com2'])
-        )
-        # update
-        long_df = long_df[~idx]
-
-    # reset row names
-    long_df.reset_index(drop=True, inplace=True)
+    long_df = pd.DataFrame({
+        'com1': name[ia],
+        'com2': name[ib],
+        'var': arr[ia, ib],
+    })
 
     return long_df
 
@@ -1,4 +1,6 @@
+import os
 import time
+import hashlib
 
 
 # ------------------------------------------------------------------------
@@ -74,6 +76,132 @@ def flatten_list(list):
     return res
 
 
+# -------------------------------------------------------------------------
+# Get number of parallel jobs
+def get_n_jobs(n_jobs=1):
+    """
+    Get number of parallel jobs.
+
+    Parameters
+    ----------
+    n_jobs : int
+        Number of jobs. Negative values count from the number of
+        processors, e.g. -1 means all processors and -2 all but one.
+
+    Returns
+    -------
+    int
+        Number of jobs, at least 1.
+    """
+
+    if n_jobs is None:
+        return 1
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        n_jobs = (os.cpu_count() or 1) + 1 + n_jobs
+
+    return max(n_jobs, 1)
+
+
+# -------------------------------------------------------------------------
+# Parse a memory size such as '4G'
+def parse_size(size):
+    """
+    Parse a memory size.
+
+    Parameters
+    ----------
+    size : str or int
+        Number of bytes, or a number with unit K, M, G or T (powers of
+        1024), e.g. '512M', '4G' or '1.5GB'.
+
+    Returns
+    -------
+    int
+        Number of bytes.
+    """
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    units = {"": 0, "K": 1, "M": 2, "G": 3, "T": 4}
+    val = size.strip().upper()
+    if val.endswith("B"):
+        val = val[:-1]
+    unit = val[-1:] if val[-1:] in units else ""
+    try:
+        num = float(val[:len(val) - len(unit)])
+    except ValueError:
+        raise ValueError("Invalid memory size: {}".format(size))
+
+    return int(num * 1024 ** units[unit])
+
+
+# -------------------------------------------------------------------------
+# Get directory of on-disk cache
+def get_cache_dir():
+    """
+    Get directory of on-disk cache.
+
+    Returns
+    -------
+    str
+        Directory given by environment variable `LAMP_CACHE_DIR`, otherwise
+        `lamp` under `XDG_CACHE_HOME` or `~/.cache`. It may not exist.
+    """
+
+    path = os.environ.get("LAMP_CACHE_DIR")
+    if not path:
+        base = (os.environ.get("XDG_CACHE_HOME") or
+                os.path.join(os.path.expanduser("~"), ".cache"))
+        path = os.path.join(base, "lamp")
+
+    return path
+
+
+# -------------------------------------------------------------------------
+# Get maximal size of on-disk cache
+def get_cache_size():
+    """
+    Get maximal size of on-disk cache.
+
+    Returns
+    -------
+    int
+        Size in bytes given by environment variable `LAMP_CACHE_SIZE`,
+        otherwise 1 GiB.
+    """
+
+    size = os.environ.get("LAMP_CACHE_SIZE")
+
+    return int(size) if size else 2 ** 30
+
+
+# -------------------------------------------------------------------------
+# Get SHA-256 digest of a file
+def file_hash(fn):
+    """
+    Get SHA-256 digest of a file.
+
+    Parameters
+    ----------
+    fn : str
+        A file name.
+
+    Returns
+    -------
+    str
+        Hex digest of file content.
+    """
+
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
 # -------------------------------------------------------------------------
 # wl-02-08-2022, Tue: Measure running time.
 # Matlab's tic and toc time measuring. From https://bit.ly/3SuXktQ
@@ -0,0 +1,454 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from pyteomics import mass
+from lamp import anno
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "examples", "data")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # never touch the user's cache
+    path = tmp_path / "cache"
+    monkeypatch.setenv("LAMP_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture(scope="module")
+def peak():
+    return anno.read_peak(os.path.join(DATA, "df_pos_3.tsv"))
+
+
+@pytest.fixture(scope="module")
+def ref():
+    return anno.read_ref(os.path.join(DATA, "kegg_full_20210111_v1.tsv"),
+                         cache=False)
+
+
+@pytest.fixture(scope="module")
+def lib():
+    return anno.read_lib(os.path.join(DATA, "adducts_short.tsv"))
+
+
+def _mixed_ref(path):
+    df = pd.DataFrame({
+        "compound_name": ["b", "a", "d", "c", "e"],
+        "molecular_formula": ["C6H12O6", "CH4", "C2H6O", "H2O", "CO2"],
+        "ion_mode": ["pos", "neg", "pos", "pos", "neg"],
+        "flag": [True, False, True, "yes", None],
+        "note": ["x", 1, 2.5, None, "y"],
+        "known": [True, False, False, True, True],
+    })
+    fn = os.path.join(path, "ref.xlsx")
+    df.to_excel(fn, index=False)
+
+    return fn
+
+
+@pytest.mark.parametrize("fn, calc", [
+    (os.path.join(DATA, "kegg_full_20210111_v1.tsv"), False),
+    (os.path.join(DATA, "hmdb_urine_v4_0_20200910_v1.tsv"), True),
+    (None, True),
+])
+def test_read_ref_cache_transparent(fn, calc, cache_dir, tmp_path):
+    fn = fn or _mixed_ref(str(tmp_path))
+    lib = anno.read_lib(os.path.join(DATA, "adducts_short.tsv"))
+    exp = anno.read_ref(fn, calc=calc, lib_adducts=lib, cache=False)
+
+    # first call fills the cache, second call reads it
+    for _ in range(2):
+        res = anno.read_ref(fn, calc=calc, lib_adducts=lib, cache=True)
+        pd.testing.assert_frame_equal(res, exp)
+    assert len(os.listdir(cache_dir / "ref")) == 1
+
+
+def test_index_sorted_by_mass(tmp_path):
+    ref = anno.read_ref(os.path.join(DATA, "kegg_full_20210111_v1.tsv"),
+                        cache=False)
+    anno.write_index(str(tmp_path / "idx"), ref)
+    res = anno.read_index(str(tmp_path / "idx"))
+
+    assert res["exact_mass"].dropna().is_monotonic_increasing
+    assert res.index.equals(pd.RangeIndex(len(ref)))
+    exp = ref.sort_values("exact_mass", kind="stable").reset_index(drop=True)
+    pd.testing.assert_frame_equal(res, exp)
+
+
+def _rt_data():
+    rng = np.random.default_rng(1)
+    ref = pd.DataFrame({
+        "compound_name": ["c{}".format(i) for i in range(400)],
+        "exact_mass": np.round(rng.uniform(100, 110, 400), 4),
+        "rt": rng.uniform(0, 10, 400),
+    })
+    ref.loc[::37, "rt"] = np.nan
+    peak = pd.DataFrame({
+        "name": ["p{}".format(i) for i in range(60)],
+        "mz": np.round(rng.uniform(100, 110, 60), 4),
+        "rt": rng.uniform(0, 10, 60),
+    })
+    peak.loc[::13, "rt"] = np.nan
+
+    return peak, ref
+
+
+def _match_key(res):
+    add = res["adduct"] if "adduct" in res else [None] * len(res)
+    return sorted(zip(res["id"], res["compound_name"], add))
+
+
+@pytest.mark.parametrize("adduct", [False, True])
+@pytest.mark.parametrize("engine, n_jobs", [
+    ("numpy", 1), ("sweep", 1), ("numpy", 2), ("sweep", 2), ("sqlite", 1),
+])
+def test_match_rt_tol(engine, n_jobs, adduct):
+    peak, ref = _rt_data()
+    lib = anno.read_lib(os.path.join(DATA, "adducts_short.tsv"))
+
+    def match(**kw):
+        if adduct:
+            return anno.comp_match_mass_add(peak, 50, ref, lib, **kw)
+        return anno.comp_match_mass(peak, 50, ref, **kw)
+
+    res = match(engine=engine, n_jobs=n_jobs, rt_tol=1.0)
+    full = match(engine=engine, n_jobs=n_jobs)
+
+    # matches are inside the tolerance unless retention time is missing
+    diff = np.abs(res["rt"] - res["id"].map(dict(zip(peak.name, peak.rt))))
+    assert (diff.isna() | (diff <= 1.0)).all()
+    assert 0 < len(res) < len(full)
+    # every engine gives the same matches
+    assert _match_key(res) == _match_key(match(rt_tol=1.0))
+
+
+def test_read_ref_cache_evict(cache_dir, tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    fns = []
+    for x in "abc":
+        fn = str(tmp_path / "{}.tsv".format(x))
+        pd.DataFrame({
+            "compound_name": ["{}{}".format(x, i) for i in range(2000)],
+            "exact_mass": rng.uniform(100, 1000, 2000),
+        }).to_csv(fn, sep="\t", index=False)
+        fns.append(fn)
+    key = [anno._ref_cache_key(x, "pos", 0, "\t", False, None) for x in fns]
+    root = cache_dir / "ref"
+
+    def size(k):
+        return sum(os.path.getsize(os.path.join(d, x))
+                   for d, _, files in os.walk(root / k) for x in files)
+
+    # room for two entries but not three
+    anno.read_ref(fns[0])
+    monkeypatch.setenv("LAMP_CACHE_SIZE", str(int(size(key[0]) * 2.5)))
+    anno.read_ref(fns[1])
+    os.utime(root / key[0] / "meta.json", (1000, 1000))
+    os.utime(root / key[1] / "meta.json", (2000, 2000))
+
+    # a cache hit marks 'a' as recently used, so 'b' is removed for 'c'
+    anno.read_ref(fns[0])
+    anno.read_ref(fns[2])
+    assert sorted(os.listdir(root)) == sorted([key[0], key[2]])
+
+
+@pytest.mark.parametrize("ppm", [1.0, 5.0])
+def test_comp_match_mass_numpy(peak, ref, ppm):
+    res = anno.comp_match_mass(peak, ppm, ref, engine="numpy")
+    exp = anno.comp_match_mass(peak, ppm, ref, engine="sqlite")
+
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, exp)
+
+
+@pytest.mark.parametrize("ppm", [1.0, 5.0])
+def test_comp_match_mass_add_numpy(peak, ref, lib, ppm):
+    res = anno.comp_match_mass_add(peak, ppm, ref, lib, engine="numpy")
+    exp = anno.comp_match_mass_add(peak, ppm, ref, lib, engine="sqlite")
+
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, exp)
+
+
+def _windows(seed):
+    rng = np.random.default_rng(seed)
+    mass = np.sort(np.round(rng.uniform(0, 100, 500), 1))
+    lo = rng.uniform(-10, 110, 300)
+    hi = lo + rng.uniform(-1, 5, 300)
+    # empty, missing and overlapping windows
+    hi[:20] = lo[:20] - 1
+    lo[20:30] = np.nan
+    lo[30:60], hi[30:60] = 50.0, 60.0
+
+    return lo, hi, mass
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_sweep_join(seed, monkeypatch):
+    lo, hi, mass = _windows(seed)
+    exp = anno._search_mass(lo, hi, mass)
+
+    res = anno._sweep_join(lo, hi, mass)
+    np.testing.assert_array_equal(res[0], exp[0])
+    np.testing.assert_array_equal(res[1], exp[1])
+
+    # the kernel in pure Python, as compiled by numba if installed
+    kernel = getattr(anno._sweep_kernel, "py_func", anno._sweep_kernel)
+    monkeypatch.setattr(anno, "njit", lambda *x, **y: None)
+    monkeypatch.setattr(anno, "_sweep_kernel", kernel)
+    res = anno._sweep_join(lo, hi, mass)
+    np.testing.assert_array_equal(res[0], exp[0])
+    np.testing.assert_array_equal(res[1], exp[1])
+
+
+@pytest.mark.parametrize("adduct", [False, True])
+@pytest.mark.parametrize("engine", ["numpy", "sweep", "sqlite"])
+def test_comp_match_mass_ppm(peak, ref, lib, engine, adduct):
+    ppm = [1.0, 5.0, 2.5]
+    lib = lib if adduct else None
+    res = anno.comp_match_mass_ppm(peak, ppm, ref, lib_adducts=lib,
+                                   engine=engine)
+
+    assert list(res["ppm"].unique()) == ppm
+    for x in ppm:
+        if adduct:
+            exp = anno.comp_match_mass_add(peak, x, ref, lib, engine=engine)
+        else:
+            exp = anno.comp_match_mass(peak, x, ref, engine=engine)
+        tab = res[res["ppm"] == x].drop("ppm", axis=1)
+        pd.testing.assert_frame_equal(tab.reset_index(drop=True), exp)
+
+
+@pytest.mark.parametrize("adduct", [False, True])
+@pytest.mark.parametrize("chunk_size", [97, 333, 10000])
+def test_iter_match_mass(peak, ref, lib, chunk_size, adduct):
+    lib = lib if adduct else None
+    res = anno.iter_match_mass(peak, 5.0, ref, lib_adducts=lib,
+                               chunk_size=chunk_size)
+    res = pd.concat(list(res), ignore_index=True)
+    if adduct:
+        exp = anno.comp_match_mass_add(peak, 5.0, ref, lib)
+    else:
+        exp = anno.comp_match_mass(peak, 5.0, ref)
+
+    pd.testing.assert_frame_equal(res, exp)
+
+
+@pytest.mark.parametrize("ext", ["tsv", "db"])
+def test_write_match_chunks(peak, ref, lib, tmp_path, ext):
+    fn = [str(tmp_path / "{}.{}".format(x, ext)) for x in ("one", "many")]
+    n = [anno.write_match(anno.iter_match_mass(peak, 5.0, ref, lib,
+                                               chunk_size=x), f)
+         for x, f in zip([len(peak), 100], fn)]
+
+    assert n[0] == n[1] > 0
+    if ext == "tsv":
+        with open(fn[0]) as a, open(fn[1]) as b:
+            assert a.read() == b.read()
+    else:
+        res = []
+        for x in fn:
+            con = sqlite3.connect(x)
+            res.append(pd.read_sql("select * from match", con))
+            con.close()
+        assert len(res[0]) == n[0]
+        pd.testing.assert_frame_equal(res[1], res[0])
+
+
+@pytest.mark.parametrize("adduct", [False, True])
+@pytest.mark.parametrize("engine", ["numpy", "sweep"])
+def test_match_n_jobs(peak, ref, lib, engine, adduct):
+    if adduct:
+        res = [anno.comp_match_mass_add(peak, 5.0, ref, lib, engine=engine,
+                                        n_jobs=x) for x in (1, 2)]
+    else:
+        res = [anno.comp_match_mass(peak, 5.0, ref, engine=engine, n_jobs=x)
+               for x in (1, 2)]
+
+    assert len(res[0]) > 0
+    pd.testing.assert_frame_equal(res[1], res[0])
+
+
+def test_index_round_trip(tmp_path):
+    ref = pd.DataFrame({
+        "compound_name": ["b", "a", None, "ü"],
+        "flag": [True, None, "yes", 1],
+        "note": [2.5, np.nan, "x", False],
+        "known": [True, False, False, True],
+        "n": np.array([3, 1, 2, 4], dtype=np.int32),
+        "day": pd.date_range("2024-01-01", periods=4),
+        "exact_mass": [300.0, 100.0, np.nan, 200.0],
+    })
+    lib = pd.DataFrame({"label": ["[M+H]+", "[M+Na]+"],
+                        "exact_mass": [1.007276, 22.989221],
+                        "charge": [1, 1]})
+    fn = str(tmp_path / "idx")
+    meta = anno.write_index(fn, ref, lib_adducts=lib, ion_mode="pos")
+
+    assert anno.is_index(fn)
+    assert meta == anno.read_index_meta(fn)
+    res = anno.read_index(fn)
+    exp = ref.iloc[[1, 3, 0, 2]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(res, exp)
+    assert list(map(type, res["flag"])) == [type(None), int, bool, str]
+    assert list(map(type, res["note"])) == [float, bool, float, str]
+    pd.testing.assert_frame_equal(anno.read_lib(fn), lib)
+
+    # unsorted index keeps row labels
+    ref.index = [10, 30, 20, 40]
+    anno.write_index(str(tmp_path / "raw"), ref, sort=False)
+    pd.testing.assert_frame_equal(anno.read_index(str(tmp_path / "raw")),
+                                  ref)
+
+    # another version of index format is rejected
+    with open(os.path.join(fn, "meta.json")) as f:
+        meta = json.load(f)
+    meta["version"] = 1
+    with open(os.path.join(fn, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError, match="build it again"):
+        anno.read_index(fn)
+
+
+@pytest.mark.parametrize("fn, calc", [
+    ("kegg_full_20210111_v1.tsv", False),
+    ("hmdb_urine_v4_0_20200910_v1.tsv", True),
+])
+def test_read_ref_index(fn, calc, lib, tmp_path):
+    fn = os.path.join(DATA, fn)
+    exp = anno.read_ref(fn, calc=calc, lib_adducts=lib, cache=False)
+    idx = str(tmp_path / "idx")
+    anno.write_index(idx, exp, lib_adducts=lib, ion_mode="pos", calc=calc,
+                     source=fn)
+
+    res = anno.read_ref(idx, calc=calc, lib_adducts=lib)
+    exp = exp.sort_values("exact_mass", kind="stable")
+    pd.testing.assert_frame_equal(res, exp.reset_index(drop=True))
+    pd.testing.assert_frame_equal(anno.read_lib(idx), lib)
+
+
+def test_read_refs():
+    fns = [os.path.join(DATA, x) for x in ("kegg_full_20210111_v1.tsv",
+                                           "hmdb_urine_v4_0_20200910_v1.tsv")]
+    res = anno.read_refs(fns, calc=True, cache=False)
+    exp = [anno.read_ref(x, calc=True, cache=False) for x in fns]
+
+    assert list(res["library"].unique()) == ["kegg_full_20210111_v1",
+                                             "hmdb_urine_v4_0_20200910_v1"]
+    assert len(res) == sum(map(len, exp))
+    for x, lib in zip(exp, res["library"].unique()):
+        tab = res[res["library"] == lib].drop("library", axis=1)
+        tab = tab[x.columns].reset_index(drop=True)
+        pd.testing.assert_frame_equal(tab, x.reset_index(drop=True))
+
+    with pytest.raises(ValueError, match="different names"):
+        anno.read_refs([fns[0], fns[0]], cache=False)
+
+
+def test_cal_mass_pyteomics():
+    formula = [
+        "C6H12O6", "H2O", "CH3COOH", "C6H12O6Cl", "",
+        # isotopes, deuterium and tritium
+        "C[13]6H12O6", "H[2]2O", "O[18]2", "D2O", "T2O", "HDO",
+        # zero and negative counts
+        "H0", "C0H4", "C-1",
+        # charges
+        "H+", "Na+", "C2H5O-", "C6H12O6+", "H+2",
+        # unknown elements or isotopes and malformed formulas
+        "Xx2", "E", "Fe[999]", "c6h12o6", "(CH3)2", "C1.5", "CH4 ",
+        # missing
+        None, np.nan, "nan", "None",
+    ]
+    mass_data = anno._nist_mass()
+    res = anno._cal_mass(formula, mass_data)
+
+    exp = []
+    for x in formula:
+        try:
+            exp.append(mass.calculate_mass(formula=str(x),
+                                           mass_data=mass_data))
+        except Exception:
+            exp.append(np.nan)
+    np.testing.assert_allclose(res, exp, rtol=1e-12)
+    assert np.isnan(res).sum() == 16
+
+
+def test_formula_mass_cache():
+    anno.mass_cache_clear()
+    formula = ["H2O", "CH4", "H2O", "Xx", "H2O"]
+    res = anno._formula_mass(formula)
+    np.testing.assert_array_equal(
+        res, anno._cal_mass(formula, anno._nist_mass()))
+    info = anno.mass_cache_info()
+    assert (info["rows"], info["unique"], info["hits"], info["misses"],
+            info["size"]) == (5, 3, 0, 3, 3)
+
+    anno._formula_mass(["CO2", "H2O", "Xx", "CO2"])
+    info = anno.mass_cache_info()
+    assert (info["rows"], info["unique"], info["hits"], info["misses"],
+            info["size"]) == (9, 6, 2, 4, 4)
+
+    anno.mass_cache_clear()
+    info = anno.mass_cache_info()
+    assert (info["rows"], info["unique"], info["hits"], info["misses"],
+            info["size"]) == (0, 0, 0, 0, 0)
+
+
+def test_nist_mass_cache(cache_dir, monkeypatch):
+    fn = os.path.join(os.path.dirname(anno.__file__), "lib",
+                      "nist_database.txt")
+    exp = anno._nist_database_to_pyteomics(fn)
+    parse = anno._nist_database_to_pyteomics
+    calls = []
+
+    def count(*args, **kw):
+        calls.append(args)
+        return parse(*args, **kw)
+
+    monkeypatch.setattr(anno, "_nist_database_to_pyteomics", count)
+    nist_mass = anno._nist_mass.__wrapped__
+
+    # parsed and written on the first call
+    assert nist_mass() == exp
+    assert len(calls) == 1
+    with open(cache_dir / "nist_mass.json") as f:
+        obj = json.load(f)
+    assert obj["sha256"] == anno.file_hash(fn)
+
+    # reused while the digest matches
+    res = nist_mass()
+    assert res == exp
+    assert list(res["C"]) == list(exp["C"])
+    assert len(calls) == 1
+
+    # parsed again if the database changed
+    obj["sha256"] = "0" * 64
+    with open(cache_dir / "nist_mass.json", "w") as f:
+        json.dump(obj, f)
+    assert nist_mass() == exp
+    assert len(calls) == 2
+    with open(cache_dir / "nist_mass.json") as f:
+        assert json.load(f)["sha256"] == anno.file_hash(fn)
+
+
+def test_adj_mass(lib):
+    add = dict(zip(lib.iloc[:, 0], lib.iloc[:, 1]))
+    df = pd.DataFrame({
+        "exact_mass": [100.0, 200.0, 300.0, np.nan, 400.0, 500.0],
+        "adduct": ["[M+H]+", "[M+Na]+", "[M+X]+", "[M+H]+", None, np.nan],
+    })
+    res = anno._adj_mass(df["exact_mass"], df["adduct"], add)
+
+    # row-wise adjustment as before
+    def adj(x):
+        if x.adduct in add:
+            return x.exact_mass + add[x.adduct]
+        return x.exact_mass
+
+    exp = df.apply(adj, axis=1).to_numpy()
+    np.testing.assert_array_equal(res, exp)
+    assert res[0] != 100.0 and res[2] == 300.0
@@ -0,0 +1,294 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.stats
+import pytest
+from lamp import anno, stats
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "examples", "data")
+
+
+@pytest.fixture(scope="module")
+def peak():
+    return anno.read_peak(os.path.join(DATA, "df_pos_3.tsv")).iloc[:600]
+
+
+def test_corr_grp_size_cliques_greedy():
+    # two triangles a-b-c and b-c-d share the edge b-c. Both are maximal
+    # cliques, but the greedy partition leaves d alone.
+    corr = pd.DataFrame({
+        "name_a": ["a", "a", "b", "b", "c"],
+        "name_b": ["b", "c", "c", "d", "d"],
+    })
+    res = stats.corr_grp_size(corr, grouping="cliques")
+    grp = dict(zip(res["name"], res["cor_grp"]))
+
+    assert grp == {"a": "a::b::c", "b": "a::b::c", "c": "a::b::c", "d": "d"}
+    # each group is a clique
+    edges = set(zip(corr["name_a"], corr["name_b"]))
+    edges |= {(y, x) for x, y in edges}
+    for g in set(grp.values()):
+        member = g.split("::")
+        assert all((x, y) in edges for x in member for y in member if x != y)
+
+    res = stats.corr_grp_size(corr, grouping="components")
+    assert set(res["cor_grp"]) == {"a::b::c::d"}
+
+
+@pytest.mark.parametrize("n", [0, 1])
+def test_comp_corr_rt_few_features(n):
+    df = pd.DataFrame({
+        "name": ["a", "b"][:n],
+        "mz": [100.0, 200.0][:n],
+        "rt": [1.0, 2.0][:n],
+        "s1": [1.0, 2.0][:n],
+        "s2": [2.0, 1.0][:n],
+    })
+    res = [stats.comp_corr_rt(df, engine=x)
+           for x in ("tile", "dense", "sparse")]
+
+    assert list(res[0].columns) == ["name_a", "name_b", "r_value",
+                                    "p_value", "rt_diff"]
+    assert len(res[0]) == 0
+    for x in res[1:]:
+        pd.testing.assert_frame_equal(x, res[0])
+
+
+def test_comp_corr_rt_float32(peak):
+    res = [stats.comp_corr_rt(peak, thres_rt=1.0, thres_corr=0.5, engine=x,
+                              dtype="float32")
+           for x in ("tile", "dense", "sparse")]
+
+    assert len(res[0]) > 0
+    assert (res[0].dtypes.iloc[2:] == "float64").all()
+    # 'sparse' calculates in double precision
+    for x in res[1:]:
+        pd.testing.assert_frame_equal(x, res[0], rtol=1e-4)
+
+
+def test_df_corr_pval_pairwise():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(15, 6))
+    x[:, 1] += x[:, 0]
+    x[rng.random(x.shape) < 0.25] = np.nan
+    # too few observations in common with others
+    x[3:, 5] = np.nan
+    df = pd.DataFrame(x, columns=["c{}".format(i) for i in range(6)])
+
+    corr, pval, nobs = stats.df_corr_pval(df, nobs=True)
+    for a in range(6):
+        for b in range(6):
+            ok = ~(np.isnan(x[:, a]) | np.isnan(x[:, b]))
+            assert nobs.iloc[a, b] == ok.sum()
+            if ok.sum() < 4:
+                assert np.isnan(corr.iloc[a, b])
+                assert np.isnan(pval.iloc[a, b])
+            elif a != b:
+                r, p = scipy.stats.pearsonr(x[ok, a], x[ok, b])
+                assert corr.iloc[a, b] == pytest.approx(r, abs=1e-12)
+                assert pval.iloc[a, b] == pytest.approx(p, rel=1e-8)
+
+    res = stats.df_corr_pval(df)
+    assert len(res) == 2
+    pd.testing.assert_frame_equal(res[0], corr)
+    pd.testing.assert_frame_equal(res[1], pval)
+
+
+@pytest.mark.parametrize("positive", [True, False])
+def test_comp_corr_rt_tile(peak, positive, monkeypatch):
+    kw = dict(thres_rt=1.0, thres_corr=0.5, positive=positive)
+    exp = stats.comp_corr_rt(peak, engine="dense", **kw)
+
+    # a small budget splits features into several tiles
+    calls = []
+    tile = stats._corr_tile
+
+    def count(*args, **kwargs):
+        calls.append(args)
+        return tile(*args, **kwargs)
+
+    monkeypatch.setattr(stats, "_corr_tile", count)
+    res = stats.comp_corr_rt(peak, engine="tile", max_memory="1M", **kw)
+
+    assert len(calls) > 1
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, exp)
+
+
+@pytest.fixture(scope="module")
+def wide():
+    # more features than a block of 'dense' engine
+    rng = np.random.default_rng(0)
+    m = 2100
+    x = rng.normal(size=(m, 10)) + rng.normal(size=(m // 3, 10)).repeat(3, 0)
+    x[rng.random(x.shape) < 0.05] = np.nan
+    df = pd.DataFrame(x, columns=["s{}".format(i) for i in range(10)])
+    df.insert(0, "rt", rng.uniform(0, 100, m))
+    df.insert(0, "mz", rng.uniform(100, 1000, m))
+    df.insert(0, "name", ["f{}".format(i) for i in range(m)])
+
+    return df
+
+
+@pytest.mark.parametrize("engine, max_memory", [
+    ("tile", None), ("dense", None), ("sparse", "1M"),
+])
+def test_comp_corr_rt_n_jobs(wide, engine, max_memory):
+    # tiles, blocks and chunks are several, so threads share the work.
+    # 'sparse' pairs do not depend on the chunk size.
+    res = [stats.comp_corr_rt(wide, thres_rt=1.0, thres_corr=0.5,
+                              engine=engine, max_memory=max_memory,
+                              n_jobs=x) for x in (1, 4)]
+
+    assert len(res[0]) > 0
+    pd.testing.assert_frame_equal(res[1], res[0], check_exact=True)
+
+
+@pytest.mark.parametrize("thres_pval", [None, 0.05])
+def test_df_corr_pval_n_jobs(wide, thres_pval):
+    mat = wide.drop(["name", "mz", "rt"], axis=1).T
+    res = [stats.df_corr_pval(mat, nobs=True, n_jobs=x,
+                              thres_pval=thres_pval) for x in (1, 4)]
+
+    for a, b in zip(*res):
+        pd.testing.assert_frame_equal(b, a, check_exact=True)
+
+
+@pytest.mark.parametrize("thres_pval", [0.05, 1e-4])
+def test_corr_pval_thres(thres_pval):
+    rng = np.random.default_rng(0)
+    nobs = rng.integers(4, 60, 20000)
+    cc = rng.uniform(-1, 1, len(nobs))
+    # coefficients on and around the critical values
+    crit = stats._corr_crit(thres_pval, int(nobs.max()))[nobs[:3000]]
+    cc[:3000] = crit * (1 + rng.choice([-1e-12, 0, 1e-12], 3000))
+    cc[3000:3100] = np.nan
+
+    idx, pval = stats._corr_pval_thres(cc, nobs, thres_pval)
+
+    exp = stats._corr_pval_two_side(cc, nobs)
+    np.testing.assert_array_equal(idx, exp < thres_pval)
+    np.testing.assert_array_equal(pval, exp[idx])
+
+
+def _short2long_stack(df):
+    # former implementation with stack and string comparison
+    df = df.rename_axis(None).rename_axis(None, axis=1)
+    long_df = df.stack().reset_index()
+    long_df.columns = ["com1", "com2", "var"]
+    long_df = long_df[long_df["com1"] < long_df["com2"]]
+
+    return long_df.reset_index(drop=True)
+
+
+def test_df_short2long():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(30, 30))
+    x = (x + x.T) / 2
+    x[rng.random(x.shape) < 0.2] = np.nan
+    x = np.where(np.isnan(x.T), np.nan, x)
+    name = ["f{:02d}".format(i) for i in rng.permutation(30)]
+    df = pd.DataFrame(x, index=name, columns=name)
+
+    res = stats.df_short2long(df)
+
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, _short2long_stack(df))
+
+
+def test_df_short2long_duplicate():
+    x = np.array([[1.0, 0.1, 0.2, 0.3],
+                  [0.1, 1.0, 0.4, np.nan],
+                  [0.2, 0.4, 1.0, 0.6],
+                  [0.3, np.nan, 0.6, 1.0]])
+    name = ["b", "a", "b", "c"]
+    df = pd.DataFrame(x, index=name, columns=name)
+
+    res = stats.df_short2long(df)
+
+    # pairs of the same name are kept once in positional order. Pairs are
+    # in row-major order of oriented positions.
+    exp = pd.DataFrame({
+        "com1": ["b", "b", "a", "a", "b"],
+        "com2": ["b", "c", "b", "b", "c"],
+        "var": [0.2, 0.3, 0.1, 0.4, 0.6],
+    })
+    pd.testing.assert_frame_equal(res, exp)
+
+
+def test_corr_grp_size_neighbors(peak):
+    corr = stats.comp_corr_rt(peak, thres_rt=1.0, thres_corr=0.5)
+    res = stats.corr_grp_size(corr)
+
+    # former grouping by a scan of the table for each name
+    cor_nam = corr["name_a"].to_list()
+    cor_nam.extend(corr["name_b"].to_list())
+    cor_nam = list(set(cor_nam))
+    cor_grp = [stats.corr_grp(x, corr) for x in cor_nam]
+    exp = pd.DataFrame({
+        "name": cor_nam,
+        "cor_grp_size": [len(x) for x in cor_grp],
+        "cor_grp": ["::".join(x) for x in cor_grp],
+    })
+    exp = exp.sort_values("cor_grp_size", ignore_index=True,
+                          ascending=False)
+
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, exp)
+
+
+def test_corr_state(peak, tmp_path):
+    info = ["name", "mz", "rt"]
+    sample = [x for x in peak.columns if x not in info]
+    exp = stats.comp_corr_rt(peak, thres_rt=1.0, thres_corr=0.5,
+                             engine="sparse")
+
+    state = stats.corr_state(peak[info + sample[:20]], thres_rt=1.0)
+    state = stats.corr_state_update(state, peak[info + sample[20:]])
+    res = stats.corr_state_table(state, thres_corr=0.5)
+
+    assert len(res) > 0
+    pd.testing.assert_frame_equal(res, exp, rtol=1e-9)
+    # a tighter window of the same state
+    pd.testing.assert_frame_equal(
+        stats.corr_state_table(state, thres_rt=0.5, thres_corr=0.5),
+        stats.comp_corr_rt(peak, thres_rt=0.5, thres_corr=0.5,
+                           engine="sparse"), rtol=1e-9)
+
+    # samples are only added once
+    with pytest.raises(ValueError, match="already"):
+        stats.corr_state_update(state, peak[info + sample[10:12]])
+
+    # save and load
+    fn = str(tmp_path / "state.npz")
+    stats.save_corr_state(state, fn)
+    load = stats.load_corr_state(fn)
+    assert set(load) == set(state)
+    for k in state:
+        np.testing.assert_array_equal(np.asarray(load[k]),
+                                      np.asarray(state[k]))
+    pd.testing.assert_frame_equal(
+        stats.corr_state_table(load, thres_corr=0.5), res)
+
+
+def test_comp_corr_rt_sparse_budget(peak, monkeypatch):
+    exp = stats.comp_corr_rt(peak, thres_rt=1.0, thres_corr=0.5,
+                             engine="sparse")
+
+    # sums of pairs without numba follow the memory budget
+    steps = []
+    pair_sums = stats._pair_sums
+
+    def spy(mat, ia, ib, step=100000):
+        steps.append(step)
+        return pair_sums(mat, ia, ib, step)
+
+    monkeypatch.setattr(stats, "njit", None)
+    monkeypatch.setattr(stats, "_pair_sums", spy)
+    res = stats.comp_corr_rt(peak, thres_rt=1.0, thres_corr=0.5,
+                             engine="sparse", max_memory="1M", n_jobs=2)
+
+    n = peak.shape[1] - 3
+    assert steps and all(0 < x * 72 * n <= 2 ** 20 // 4 for x in steps)
+    pd.testing.assert_frame_equal(res, exp, rtol=1e-12)